@@ -2,13 +2,12 @@ import csv
 import logging
 import os
 import shutil
-from typing import Optional
 import rasterio
 from rasterio.io import DatasetReader
 import pythia.analytic_functions
 import pythia.io
+import pythia.manifest
 import pythia.util
-from contextlib import _GeneratorContextManager
 
 
 def get_run_basedir(config, run):
@@ -27,6 +26,12 @@ def extract_ll(path):
     return tuple([pythia.util.translate_news_coords(coords) for coords in ll])
 
 
+def format_ll(lat, lng):
+    """The coordinates as extract_ll reads them from the pixel directory name."""
+    ll = pythia.util.translate_coords_news(lat, lng)
+    return tuple([pythia.util.translate_news_coords(coords) for coords in ll])
+
+
 # Always by default keep the per_pixel_per_management file, but create a place
 # for the single output or analytics, should we have a "final outputs"
 # directory.
@@ -156,109 +161,141 @@ def combine_outputs(config, outputs):
                         dest.write(line)
 
 
-def collate_outputs(config, run):
-    analytics_config = config.get("analytics_setup", {})
-    per_pixel_file_name = "{}_{}.csv".format(
-        analytics_config.get("per_pixel_prefix", "pp"), run["name"]
-    )
-    work_dir = get_run_basedir(config, run)
-    out_dir = os.path.join(config.get("workDir", "."), "scratch")
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-    out_file = os.path.join(out_dir, per_pixel_file_name)
-    harea_info = run.get("harvestArea", None)
-    pop_info = run.get("population", None)
-    season_info = run.get("season", None)
-    mgmt_info = run.get("management", None)
-    late_season_flag = run.get("lateSeason", False)
-    collected_first_line = False
-    for current_dir in _generated_run_files(work_dir, "summary.csv"):
-        lat, lng = extract_ll(current_dir)
-        if collected_first_line:
-            mode = "a"
+class RunCollator:
+    """Collects the summary.csv rows of the pixel directories of a run into the
+    per pixel file of the run, one directory at a time."""
+
+    def __init__(self, config, run):
+        analytics_config = config.get("analytics_setup", {})
+        per_pixel_file_name = "{}_{}.csv".format(
+            analytics_config.get("per_pixel_prefix", "pp"), run["name"]
+        )
+        out_dir = os.path.join(config.get("workDir", "."), "scratch")
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.out_file = os.path.join(out_dir, per_pixel_file_name)
+        self.run = run
+        self.harea_info = run.get("harvestArea", None)
+        self.pop_info = run.get("population", None)
+        self.season_info = run.get("season", None)
+        self.mgmt_info = run.get("management", None)
+        self.late_season_flag = run.get("lateSeason", False)
+        self.additional_headers = "LATITUDE,LONGITUDE,RUN_NAME"
+        if self.season_info:
+            self.additional_headers = f"{self.additional_headers},SEASON,LATE_SEASON"
+        if self.mgmt_info:
+            self.additional_headers = f"{self.additional_headers},MGMT"
+        if self.harea_info:
+            self.additional_headers = f"{self.additional_headers},HARVEST_AREA"
+        if self.pop_info:
+            self.additional_headers = f"{self.additional_headers},POPULATION"
+        self.collected_first_line = False
+        self.dest = None
+        self.rasters = {}
+
+    def _raster_value(self, info, lat, lng):
+        # The rasters are read once for the whole run, and only when a value is
+        #  not already known from the run manifest.
+        if info not in self.rasters:
+            ds: DatasetReader = rasterio.open(info.split("::")[1])
+            self.rasters[info] = (ds, ds.read(1))
+        ds, band = self.rasters[info]
+        return pythia.io.get_site_raster_value(ds, band, (float(lng), float(lat)))
+
+    def add(self, current_dir, coords=None, attributes=None):
+        """Collect the summary.csv rows of a pixel directory. The coordinates
+        are parsed from the directory name unless given, and the harvest area
+        and population are looked up in the rasters unless given in
+        attributes."""
+        summary = os.path.join(current_dir, "summary.csv")
+        if not os.path.exists(summary):
+            return
+        if self.dest is None:
+            self.dest = open(self.out_file, "w")
+        if coords is None:
+            lat, lng = extract_ll(current_dir)
         else:
-            mode = "w"
-        with open(os.path.join(current_dir, "summary.csv")) as source, open(
-            out_file, mode
-        ) as dest:
-            additional_headers = "LATITUDE,LONGITUDE,RUN_NAME"
-            ds_harea: Optional[_GeneratorContextManager[DatasetReader]] = None
-            ds_pop: Optional[_GeneratorContextManager[DatasetReader]] = None
-            band_harea = None
-            band_pop = None
-            if season_info:
-                additional_headers = f"{additional_headers},SEASON,LATE_SEASON"
-            if mgmt_info:
-                additional_headers = f"{additional_headers},MGMT"
-            if harea_info:
-                additional_headers = f"{additional_headers},HARVEST_AREA"
-                harea_tiff = harea_info.split("::")[1]
-                ds_harea = rasterio.open(harea_tiff)
-                band_harea = ds_harea.read(1)
-            if pop_info:
-                additional_headers = f"{additional_headers},POPULATION"
-                pop_tiff = pop_info.split("::")[1]
-                ds_pop = rasterio.open(pop_tiff)
-                band_pop = ds_pop.read(1)
-                band_pop = ds_pop.read(1)
+            lat, lng = format_ll(*coords)
+        attributes = attributes or {}
+        with open(summary) as source:
             for i, line in enumerate(source):
                 if i == 0:
-                    if not collected_first_line:
-                        dest.write("{},{}\n".format(additional_headers, line.strip()))
-                        collected_first_line = True
-                else:
-                    to_write = (lat, lng, run.get("name", ""))
-                    if season_info is not None:
-                        to_write = to_write + (season_info,)
-                        if late_season_flag:
-                            to_write = to_write + (str(True),)
-                        else:
-                            to_write = to_write + (str(False),)
-                    if mgmt_info is not None:
-                        to_write = to_write + (mgmt_info,)
-                    if ds_harea is not None and not ds_harea.closed:
-                        harea = pythia.io.get_site_raster_value(
-                            ds_harea, band_harea, (float(lng), float(lat))
+                    if not self.collected_first_line:
+                        self.dest.write(
+                            "{},{}\n".format(self.additional_headers, line.strip())
                         )
-                        if harea is None:
-                            harea = 0
-                            logging.warning(
-                                "%s, %s is giving an invalid harea, replacing with 0"
-                            )
-                        harea_s = "{:0.2f}".format(harea)
-                        to_write = to_write + (harea_s,)
-                    if ds_pop is not None and not ds_pop.closed:
-                        pop = pythia.io.get_site_raster_value(
-                            ds_pop, band_pop, (float(lng), float(lat))
-                        )
-                        if pop is None:
-                            pop = 0
-                            logging.warning(
-                                "%s, %s is giving an invalid population, replacing with 0"
-                            )
-                        pop_s = "{:0.2f}".format(pop)
-                        to_write = to_write + (pop_s,)
-                    to_write = to_write + (line.strip() + "\n",)
-                    dest.write(",".join(to_write))
-            if ds_harea is not None:
-                ds_harea.close()
-            if ds_pop is not None:
-                ds_pop.close()
-    return out_file
+                        self.collected_first_line = True
+                else:
+                    self.dest.write(",".join(self._row(lat, lng, line, attributes)))
 
+    def _row(self, lat, lng, line, attributes):
+        to_write = (lat, lng, self.run.get("name", ""))
+        if self.season_info is not None:
+            to_write = to_write + (self.season_info,)
+            if self.late_season_flag:
+                to_write = to_write + (str(True),)
+            else:
+                to_write = to_write + (str(False),)
+        if self.mgmt_info is not None:
+            to_write = to_write + (self.mgmt_info,)
+        if self.harea_info:
+            harea = attributes.get("harvestArea")
+            if harea is None:
+                harea = self._raster_value(self.harea_info, lat, lng)
+            if harea is None:
+                harea = 0
+                logging.warning(
+                    "%s, %s is giving an invalid harea, replacing with 0", lat, lng
+                )
+            to_write = to_write + ("{:0.2f}".format(harea),)
+        if self.pop_info:
+            pop = attributes.get("population")
+            if pop is None:
+                pop = self._raster_value(self.pop_info, lat, lng)
+            if pop is None:
+                pop = 0
+                logging.warning(
+                    "%s, %s is giving an invalid population, replacing with 0",
+                    lat,
+                    lng,
+                )
+            to_write = to_write + ("{:0.2f}".format(pop),)
+        return to_write + (line.strip() + "\n",)
 
-def execute(config, plugins):
-    runs = config.get("runs", [])
-    analytics_config = config.get("analytics_setup", None)
-    run_outputs = []
+    def close(self):
+        if self.dest is not None:
+            self.dest.close()
+        for ds, _ in self.rasters.values():
+            ds.close()
+        return self.out_file
+
+
+def collate_outputs(config, run):
+    collator = RunCollator(config, run)
+    manifest = pythia.manifest.open_manifest(config)
+    if manifest is not None:
+        entries = list(manifest.entries(run.get("name", "")))
+        manifest.close()
+        # A run set up without a manifest is walked below
+        if entries:
+            for entry in entries:
+                coords = None
+                if entry["lat"] is not None:
+                    coords = (entry["lat"], entry["lng"])
+                collator.add(entry["dir"], coords, entry["attributes"])
+            return collator.close()
+    work_dir = get_run_basedir(config, run)
+    for current_dir in _generated_run_files(work_dir, "summary.csv"):
+        collator.add(current_dir)
+    return collator.close()
+
+
+def finish_outputs(config, run_outputs):
+    """Apply the calculated columns and the column filter to the per pixel
+    files of the runs and write the final outputs."""
+    analytics_config = config.get("analytics_setup", {})
     calculated = None
     filtered = None
-    if not analytics_config:
-        return
-    if len(runs) == 0:
-        return
-    for run in runs:
-        run_outputs.append(collate_outputs(config, run))
     # Apply all the filters first
     if analytics_config.get("calculatedColumns", None):
         calculated = calculate_columns(config, run_outputs)
@@ -272,3 +309,16 @@ def execute(config, plugins):
         combine_outputs(config, filtered)
     else:
         final_outputs(config, filtered)
+
+
+def execute(config, plugins):
+    runs = config.get("runs", [])
+    analytics_config = config.get("analytics_setup", None)
+    run_outputs = []
+    if not analytics_config:
+        return
+    if len(runs) == 0:
+        return
+    for run in runs:
+        run_outputs.append(collate_outputs(config, run))
+    finish_outputs(config, run_outputs)
@@ -8,6 +8,7 @@ import pythia.dssat
 import pythia.analytics
 import pythia.io
 import pythia.peerless
+import pythia.pipeline
 import pythia.plugin
 
 
@@ -17,6 +18,11 @@ def main():
     parser.add_argument(
         "--all", action="store_true", help="Run all the steps in pythia"
     )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Run all the steps, running DSSAT on each directory once it is set up",
+    )
     parser.add_argument(
         "--export-runlist",
         action="store_true",
@@ -78,13 +84,16 @@ def main():
                 config["silence"] = True
             else:
                 config["silence"] = False
-            if args.all or args.setup:
+            if args.pipeline:
+                print("Running the setup, DSSAT and the analytics as a pipeline")
+                pythia.pipeline.execute(config, plugins)
+            if (args.all or args.setup) and not args.pipeline:
                 print("Setting up points and directory structure")
                 pythia.peerless.execute(config, plugins)
-            if args.all or args.run_dssat:
+            if (args.all or args.run_dssat) and not args.pipeline:
                 print("Running DSSAT over the directory structure")
                 pythia.dssat.execute(config, plugins)
-            if args.all or args.analyze:
+            if (args.all or args.analyze) and not args.pipeline:
                 print("Running simple analytics over DSSAT directory structure")
                 pythia.analytics.execute(config, plugins)
             logging.info(
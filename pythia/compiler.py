@@ -0,0 +1,136 @@
+import heapq
+import logging
+
+import numpy as np
+
+import pythia.functions
+
+
+"""Compiles the function specs (fn::args) of a run once, so evaluating them for
+every pixel does no string parsing."""
+
+
+class CompiledFunction:
+    def __init__(self, key, name, spec):
+        self.key = key
+        self.name = name
+        self.fn = getattr(pythia.functions, name)
+        self.parser = pythia.functions.arg_parsers.get(name, None)
+        self.args = None
+        if self.parser is not None:
+            self.args = self.parser(key, spec)
+        self.requires = _references(spec) + pythia.functions.function_requires.get(
+            name, []
+        )
+        self.provides = [key] + pythia.functions.function_provides.get(name, [])
+        self.cost = pythia.functions.function_costs.get(name, 0)
+
+    @property
+    def batch(self):
+        if self.args is None:
+            return None
+        return pythia.functions.batch_functions.get(self.name, None)
+
+    def __call__(self, run, context, config):
+        if self.parser is None:
+            return self.fn(self.key, run, context, config)
+        if self.args is None:
+            return None
+        return self.fn(self.key, run, context, config, args=self.args)
+
+    def __repr__(self):
+        return "CompiledFunction({}, {})".format(self.key, self.name)
+
+
+def _references(spec):
+    return [arg[1:] for arg in spec.split("::")[1:] if arg.startswith("$")]
+
+
+def order_functions(functions):
+    """Order the functions so every function runs after the functions providing
+    the context keys it requires. Functions providing the same key keep their
+    configuration order, so the last one still wins. Among the functions ready
+    to run, the cheaper ones go first and ties keep the configuration order."""
+    providers = {}
+    for idx, fn in enumerate(functions):
+        for key in fn.provides:
+            providers.setdefault(key, []).append(idx)
+    dependents = [[] for _ in functions]
+    pending = [0] * len(functions)
+    for idx, fn in enumerate(functions):
+        deps = {p for key in fn.requires for p in providers.get(key, []) if p != idx}
+        for key in fn.provides:
+            deps.update(p for p in providers[key] if p < idx)
+        pending[idx] = len(deps)
+        for dep in deps:
+            dependents[dep].append(idx)
+    ready = [(fn.cost, idx) for idx, fn in enumerate(functions) if pending[idx] == 0]
+    heapq.heapify(ready)
+    ordered = []
+    while ready:
+        _, idx = heapq.heappop(ready)
+        ordered.append(idx)
+        for dependent in dependents[idx]:
+            pending[dependent] -= 1
+            if pending[dependent] == 0:
+                heapq.heappush(ready, (functions[dependent].cost, dependent))
+    if len(ordered) != len(functions):
+        cyclic = [idx for idx in range(len(functions)) if idx not in ordered]
+        logging.error(
+            "Circular references between %s, evaluating them in configuration order",
+            ", ".join(functions[idx].key for idx in cyclic),
+        )
+        ordered.extend(cyclic)
+    return [functions[idx] for idx in ordered]
+
+
+def compile_run(run):
+    compiled = []
+    for k, v in run.items():
+        if "::" in str(v) and k != "sites":
+            fn = v.split("::")[0]
+            if fn != "raster":
+                compiled.append(CompiledFunction(k, fn, v))
+    return order_functions(compiled)
+
+
+def split_batch(functions):
+    """Split the ordered functions into the ones evaluated in batch for the
+    whole run and the ones left for build_context. A function is only batched
+    when it has a batch form and does not depend on, or overwrite, the keys of
+    a function evaluated per pixel."""
+    batched = []
+    pixel = []
+    pixel_keys = set()
+    for fn in functions:
+        keys = set(fn.requires) | set(fn.provides)
+        if fn.batch is not None and not keys & pixel_keys:
+            batched.append(fn)
+        else:
+            pixel.append(fn)
+            pixel_keys.update(fn.provides)
+    return batched, pixel
+
+
+def evaluate_batch(functions, run, peers, config):
+    """Evaluate the batch functions over the peers of a run. Returns the peers
+    with the computed columns, and the peers skipped by a failing function."""
+    columns = peers.columns()
+    valid = np.ones(len(peers), dtype=bool)
+    computed = {}
+    for fn in functions:
+        keep = np.flatnonzero(valid)
+        outputs, ok = fn.batch(
+            fn.key,
+            run,
+            {key: column[keep] for key, column in columns.items()},
+            config,
+            fn.args,
+        )
+        for key, output in outputs.items():
+            column = np.empty(len(peers), dtype=object)
+            column[keep] = output
+            columns[key] = column
+            computed[key] = column
+        valid[keep[~ok]] = False
+    return peers.with_columns(computed, valid), peers.select(peers.index[~valid])
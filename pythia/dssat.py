@@ -4,6 +4,7 @@ import os
 import subprocess
 from multiprocessing.pool import Pool
 
+import pythia.manifest
 import pythia.plugin
 
 async_error = False
@@ -39,39 +40,74 @@ def _run_dssat(details, config, plugins):
     return plugin_transform.get("loc", details["dir"]), plugin_transform.get("xfile", details["file"]), plugin_transform.get("out", out), plugin_transform.get("err", err), plugin_transform.get("retcode", dssat.returncode)
 
 
-def _generate_run_list(config):
+def _batch_mode(config):
+    return config["dssat"].get("run_mode", "A") in {
+        "B",
+        "E",
+        "F",
+        "L",
+        "N",
+        "Q",
+        "S",
+        "T",
+        "Y",
+    }
+
+
+def _run_files(config, root, files):
+    """The DSSAT runs of a directory, given the names of the files in it."""
     runlist = []
-    for root, _, files in os.walk(config.get("workDir", "."), topdown=False):
-        batch_mode = config["dssat"].get("run_mode", "A") in {
-            "B",
-            "E",
-            "F",
-            "L",
-            "N",
-            "Q",
-            "S",
-            "T",
-            "Y",
-        }
-        target = None
-        if batch_mode:
-            target = config["dssat"].get("batch_file", None)
+    batch_mode = _batch_mode(config)
+    target = None
+    if batch_mode:
+        target = config["dssat"].get("batch_file", None)
+    else:
+        target = config["dssat"].get("filex", None)
+    for name in files:
+        if target is not None:
+            if name == target:
+                runlist.append({"dir": root, "file": name})
         else:
-            target = config["dssat"].get("filex", None)
-        for name in files:
-            if target is not None:
-                if name == target:
+            if batch_mode:
+                if name.upper().startswith("DSSBATCH"):
                     runlist.append({"dir": root, "file": name})
             else:
-                if batch_mode:
-                    if name.upper().startswith("DSSBATCH"):
-                        runlist.append({"dir": root, "file": name})
-                else:
-                    if name.upper().endswith("X"):
-                        runlist.append({"dir": root, "file": name})
+                if name.upper().endswith("X"):
+                    runlist.append({"dir": root, "file": name})
+    return runlist
+
+
+def _walk_run_files(config, path):
+    runlist = []
+    for root, _, files in os.walk(path, topdown=False):
+        runlist.extend(_run_files(config, root, files))
     return runlist
 
 
+def _generate_run_list(config):
+    runlist = []
+    manifest = None
+    if not _batch_mode(config) and not config["dssat"].get("walkWorkDir", False):
+        manifest = pythia.manifest.open_manifest(config)
+    if manifest is not None:
+        recorded = set()
+        for entry in manifest.entries():
+            recorded.add(entry["run"])
+            runlist.extend(_run_files(config, entry["dir"], [entry["xfile"]]))
+        manifest.close()
+        # The runs set up without a manifest are walked
+        for run in config.get("runs", []):
+            if run.get("name", "") not in recorded:
+                runlist.extend(
+                    _walk_run_files(
+                        config,
+                        os.path.join(config.get("workDir", "."), run.get("name", "")),
+                    )
+                )
+        return runlist
+    return _walk_run_files(config, config.get("workDir", "."))
+
+
 def display_async(details):
     loc, xfile, out, error, retcode = details
     error_count = len(out.decode().split("\n")) - 1
@@ -101,17 +137,45 @@ def silent_async(details):
         async_error = True
 
 
+# The config and plugins of a DSSAT worker, set once by _init_worker.
+_worker = {}
+
+
+def _init_worker(config, plugins):
+    _worker["config"] = config
+    _worker["plugins"] = plugins
+
+
+def _run_dssat_safely(details, config, plugins):
+    """Run DSSAT on a file, an exception is reported as a failed run so a single
+    pixel does not stop the others."""
+    try:
+        return _run_dssat(details, config, plugins)
+    except Exception as e:
+        logging.exception(
+            "Unable to run DSSAT on %s in %s", details["file"], details["dir"]
+        )
+        return details["dir"], details["file"], "{}\n".format(e).encode(), b"", -1
+
+
+def _run_dssat_task(details):
+    return _run_dssat_safely(details, _worker["config"], _worker["plugins"])
+
+
 def execute(config, plugins):
     pool_size = config.get("cores", mp.cpu_count())
     run_list = _generate_run_list(config)
-    with Pool(processes=pool_size) as pool:
-        for details in run_list:  # _generate_run_list(config):
-            if config["silence"]:
-                pool.apply_async(_run_dssat, (details, config, plugins), callback=silent_async)
-            else:
-                pool.apply_async(_run_dssat, (details, config, plugins), callback=display_async)
-        pool.close()
-        pool.join()
+    chunk_size = config["dssat"].get(
+        "chunkSize", max(1, min(64, len(run_list) // (pool_size * 4)))
+    )
+    display = display_async
+    if config["silence"]:
+        display = silent_async
+    with Pool(
+        processes=pool_size, initializer=_init_worker, initargs=(config, plugins)
+    ) as pool:
+        for details in pool.imap_unordered(_run_dssat_task, run_list, chunk_size):
+            display(details)
 
     if async_error:
         print(
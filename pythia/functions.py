@@ -1,8 +1,11 @@
 import datetime
 
+import json
 import logging
 import os
 
+import numpy as np
+
 from pythia.cache_manager import cache
 import pythia.io
 import pythia.soil_handler
@@ -25,13 +28,30 @@ def xy_from_list(lst):
     return [tuple(x[::-1]) for x in lst]
 
 
-def auto_planting_window(k, run, context, _):
-    """multiple rasters not yet supported"""
-    args = run[k].split("::")[1:]
+def _args(spec):
+    return spec.split("::")[1:]
+
+
+def _parse_window_args(k, spec):
+    """The raster value takes the place of the raster file in the arguments."""
+    args = _args(spec)
     raster_idx = args.index("raster")
-    args[raster_idx + 1] = context[k]
     args.pop(raster_idx)
-    vals = [int(v) for v in args]
+    return raster_idx, [None if i == raster_idx else int(v) for i, v in enumerate(args)]
+
+
+def _window_vals(k, context, args):
+    raster_idx, vals = args
+    vals = list(vals)
+    vals[raster_idx] = int(context[k])
+    return vals
+
+
+def auto_planting_window(k, run, context, _, args=None):
+    """multiple rasters not yet supported"""
+    if args is None:
+        args = _parse_window_args(k, run[k])
+    vals = _window_vals(k, context, args)
     first = datetime.date(run["startYear"], vals[0], vals[1])
     td = datetime.timedelta(days=vals[2])
     last = first + td
@@ -41,13 +61,11 @@ def auto_planting_window(k, run, context, _):
         "plast": pythia.util.to_iso_date(last),
     }
 
-def auto_planting_window_doy(k, run, context, _):
+def auto_planting_window_doy(k, run, context, _, args=None):
     """multiple rasters not yet supported"""
-    args = run[k].split("::")[1:]
-    raster_idx = args.index("raster")
-    args[raster_idx + 1] = context[k]
-    args.pop(raster_idx)
-    vals = [int(v) for v in args]
+    if args is None:
+        args = _parse_window_args(k, run[k])
+    vals = _window_vals(k, context, args)
     first = datetime.datetime(run["startYear"], 1, 1) + datetime.timedelta(vals[0] + vals[1] - 1)
     td = datetime.timedelta(days=vals[2])
     last = first + td
@@ -57,17 +75,27 @@ def auto_planting_window_doy(k, run, context, _):
         "plast": pythia.util.to_iso_date(last),
     }
 
-def auto_planting_window_doy_shape(k, run, context, _):
+def _parse_window_shape_args(k, spec):
+    args = _args(spec)
+    idx = args.index("vector")
+    return args[idx + 1], args[idx + 2], int(args[idx + 3]), int(args[idx + 4])
+
+
+def auto_planting_window_doy_shape(k, run, context, config, args=None):
     """multiple rasters not yet supported"""
-    args = run[k].split("::")[1:]
-    finder = pythia.io.find_closest_vector_coords
-    cell_doy = None
-    if "vector" in args:
-        idx = args.index("vector")
-        cell_doy = finder(args[idx + 1], context["lng"], context["lat"], args[idx + 2])
+    if args is None:
+        args = _parse_window_shape_args(k, run[k])
+    vector, attr, offset, window = args
+    cell_doy = pythia.io.find_closest_vector_coords(
+        vector,
+        context["lng"],
+        context["lat"],
+        attr,
+        config.get("vectorSidecar", False),
+    )
 
-    first = datetime.datetime(run["startYear"], 1, 1) + datetime.timedelta(int(cell_doy) + int(args[idx + 3]) )
-    td = datetime.timedelta(days=int(args[idx + 4]))
+    first = datetime.datetime(run["startYear"], 1, 1) + datetime.timedelta(int(cell_doy) + offset)
+    td = datetime.timedelta(days=window)
     last = first + td
     return {
         "pdate": pythia.util.to_iso_date(first),
@@ -75,43 +103,168 @@ def auto_planting_window_doy_shape(k, run, context, _):
         "plast": pythia.util.to_iso_date(last),
     }
 
-def lookup_hc27(k, run, context, _):
-    args = run[k].split("::")[1:]
+def _parse_hc27_args(k, spec):
+    args = _args(spec)
     if "raster" in args:
+        return None, True
+    else:
+        return "HC_GEN{:0>4}".format(args[0]), False
+
+
+def lookup_hc27(k, run, context, _, args=None):
+    if args is None:
+        args = _parse_hc27_args(k, run[k])
+    static, from_raster = args
+    if from_raster:
         return {k: "HC_GEN{:0>4}".format(context[k])}
     else:
-        return {k: "HC_GEN{:0>4}".format(args[0])}
+        return {k: static}
 
 
-def lookup_wth(k, run, context, _):
-    args = run[k].split("::")[1:]
-    finder = pythia.io.find_closest_vector_coords
-    cell_id = None
+def _parse_wth_args(k, spec):
+    args = _args(spec)
     if "vector" in args:
         idx = args.index("vector")
-        cell_id = finder(args[idx + 1], context["lng"], context["lat"], args[idx + 2])
-    return {k: args[0], "wthFile": "{}.WTH".format(int(cell_id))}
+        return args[0], args[idx + 1], args[idx + 2]
+    return args[0], None, None
 
 
-def generate_ic_layers(k, run, context, _):
-    args = run[k].split("::")[1:]
+def lookup_wth(k, run, context, config, args=None):
+    if args is None:
+        args = _parse_wth_args(k, run[k])
+    wsta, vector, attr = args
+    cell_id = None
+    if vector is not None:
+        cell_id = pythia.io.find_closest_vector_coords(
+            vector,
+            context["lng"],
+            context["lat"],
+            attr,
+            config.get("vectorSidecar", False),
+        )
+    return {k: wsta, "wthFile": "{}.WTH".format(int(cell_id))}
+
+
+def _parse_reference(k, spec):
+    args = _args(spec)
     if args[0].startswith("$"):
-        profile = args[0][1:]
+        return args[0][1:]
     else:
-        profile = args[0]
+        return args[0]
+
+
+def generate_ic_layers(k, run, context, config, args=None):
+    if args is None:
+        args = _parse_reference(k, run[k])
+    profile = args
+    persist = config.get("soilIndexSidecar", False)
     soil_file = pythia.soil_handler.findSoilProfile(
-        context[profile], context["soilFiles"]
+        context[profile], context["soilFiles"], persist
+    )
+    calculated_layers = pythia.soil_handler.cachedICLayerData(
+        context[profile], soil_file, run["icin"], run["icsw%"], persist
     )
-    layers = pythia.soil_handler.readSoilLayers(context[profile], soil_file)
-    calculated_layers = pythia.soil_handler.calculateICLayerData(layers, run)
     layer_labels = ["icbl", "sh2o", "snh4", "sno3"]
     return {k: [dict(zip(layer_labels, cl)) for cl in calculated_layers]}
 
 
+class GHRProfiles:
+    """The GHR profile_map compiled into arrays. Dense maps are indexed by the
+    profile id directly, sparse maps binary search a sorted key array. The
+    arrays are saved to .npy files and memory mapped, so every process on a
+    node shares a single copy through the page cache."""
+
+    def __init__(self, profiles, keys=None):
+        self.profiles = profiles
+        self.keys = keys
+
+    @classmethod
+    def from_dict(cls, ghr_profiles):
+        keys = np.array(sorted(ghr_profiles), dtype=np.int64)
+        profiles = np.array([ghr_profiles[k].encode() for k in keys.tolist()])
+        if len(keys) > 0 and keys[0] >= 0 and keys[-1] < 4 * len(keys):
+            dense = np.zeros(keys[-1] + 1, dtype=profiles.dtype)
+            dense[keys] = profiles
+            return cls(dense)
+        return cls(profiles, keys)
+
+    @classmethod
+    def load(cls, cache_dir):
+        profiles = np.load(os.path.join(cache_dir, "ghr_profiles.npy"), mmap_mode="r")
+        keys_file = os.path.join(cache_dir, "ghr_keys.npy")
+        keys = None
+        if os.path.exists(keys_file):
+            keys = np.load(keys_file, mmap_mode="r")
+        return cls(profiles, keys)
+
+    def save(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        keys_file = os.path.join(cache_dir, "ghr_keys.npy")
+        if self.keys is not None:
+            _save_array(keys_file, self.keys)
+        elif os.path.exists(keys_file):
+            os.remove(keys_file)
+        _save_array(os.path.join(cache_dir, "ghr_profiles.npy"), self.profiles)
+
+    def _position(self, profile_id):
+        if self.keys is None:
+            if 0 <= profile_id < len(self.profiles) and self.profiles[profile_id]:
+                return profile_id
+            return None
+        pos = np.searchsorted(self.keys, profile_id)
+        if pos < len(self.keys) and self.keys[pos] == profile_id:
+            return pos
+        return None
+
+    def __contains__(self, profile_id):
+        return self._position(profile_id) is not None
+
+    def __getitem__(self, profile_id):
+        pos = self._position(profile_id)
+        if pos is None:
+            raise KeyError(profile_id)
+        return self.profiles[pos].decode()
+
+
+def _save_array(path, array):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def _ghr_cache_dir(config):
+    return os.path.join(config.get("ghrCacheDir", config["workDir"]), ".ghr_cache")
+
+
+def _ghr_source(db):
+    stat = os.stat(db)
+    return {"db": os.path.abspath(db), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _load_ghr_source(stamp):
+    try:
+        with open(stamp) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
 def build_ghr_cache(config):
+    """Load the GHR profile map. The map is compiled from GHR.db once and memory
+    mapped by every process, it is only recompiled when the path, size or mtime
+    of GHR.db changes."""
     import sqlite3
 
-    with sqlite3.connect(os.path.join(config["ghr_root"], "GHR.db")) as conn:
+    db = os.path.join(config["ghr_root"], "GHR.db")
+    cache_dir = _ghr_cache_dir(config)
+    stamp = os.path.join(cache_dir, "ghr_source.json")
+    source = _ghr_source(db)
+    if _load_ghr_source(stamp) == source:
+        cache["ghr_profiles"] = GHRProfiles.load(cache_dir)
+        return
+
+    with sqlite3.connect(db) as conn:
         ghr_profiles = {}
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
@@ -119,14 +272,26 @@ def build_ghr_cache(config):
         for row in cursor.fetchall():
             ghr_profiles[row["id"]] = row["profile"]
 
-        cache["ghr_profiles"] = ghr_profiles;
+    try:
+        GHRProfiles.from_dict(ghr_profiles).save(cache_dir)
+        tmp = "{}.{}.tmp".format(stamp, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(source, f)
+        os.replace(tmp, stamp)
+        cache["ghr_profiles"] = GHRProfiles.load(cache_dir)
+    except OSError:
+        logging.warning("Unable to write the GHR cache in %s", cache_dir)
+        cache["ghr_profiles"] = GHRProfiles.from_dict(ghr_profiles)
+
 
-    pass
+def _parse_raster_flag(k, spec):
+    return "raster" in _args(spec)
 
 
-def lookup_ghr(k, run, context, config):
-    args = run[k].split("::")[1:]
-    if "raster" in args:
+def lookup_ghr(k, run, context, config, args=None):
+    if args is None:
+        args = _parse_raster_flag(k, run[k])
+    if args:
         logging.debug("lookup_ghr - context[%s] => %s", k, context[k])
         if "ghr_profiles" not in cache:
             build_ghr_cache(config)
@@ -141,11 +306,21 @@ def lookup_ghr(k, run, context, config):
             return None
         id_soil = cache["ghr_profiles"][tif_profile_id]
         if id_soil and id_soil.strip() != "":
-            sol_file = "{}.SOL".format(id_soil[:2].upper())
-            return {
-                k: id_soil,
-                "soilFiles": [os.path.join(config["ghr_root"], sol_file)],
-            }
+            sol_file = os.path.join(
+                config["ghr_root"], "{}.SOL".format(id_soil[:2].upper())
+            )
+            if config.get("extractSoilProfiles", False):
+                extracted = pythia.soil_handler.extractSoilProfile(
+                    id_soil,
+                    sol_file,
+                    os.path.join(config["workDir"], ".soils"),
+                    config.get("soilIndexSidecar", False),
+                )
+                if extracted is None:
+                    logging.error("Soil profile %s not found in %s", id_soil, sol_file)
+                    return None
+                sol_file = extracted
+            return {k: id_soil, "soilFiles": [sol_file]}
         else:
             logging.error(
                 "Soil NOT found for id: %s at (%f,%f)",
@@ -156,12 +331,13 @@ def lookup_ghr(k, run, context, config):
             return None
 
 
-def split_fert_dap_percent(k, run, context, _):
-    args = run[k].split("::")[1:]
+def _parse_split_fert_args(k, spec):
+    args = _args(spec)
     if args[0].startswith("$"):
         search_context = args[0][1:]
-        total = float(context[search_context])
+        total = None
     else:
+        search_context = None
         total = float(args[0])
     # splits = int(args[1])
     split_amounts = args[2:]
@@ -184,16 +360,26 @@ def split_fert_dap_percent(k, run, context, _):
     if len(daps) != len(set(daps)):
         logging.error("Days should not be the same in split_applications_dap_percent")
         return None
+    return search_context, total, list(zip(daps, percents))
+
+
+def split_fert_dap_percent(k, run, context, _, args=None):
+    if args is None:
+        args = _parse_split_fert_args(k, run[k])
+        if args is None:
+            return None
+    search_context, total, splits = args
+    if search_context is not None:
+        total = float(context[search_context])
     out = []
-    for i in range(len(daps)):
-        app_total = total * percents[i]
-        app_dap = daps[i]
+    for app_dap, percent in splits:
+        app_total = total * percent
         out.append({"fdap": app_dap, "famn": app_total})
     return {k: out}
 
 
-def assign_by_raster_value(k, run, context, _):
-    init_args = run[k].split("::")[1:]
+def _parse_assign_args(k, spec):
+    init_args = _args(spec)
     if "raster" in init_args:
         args = init_args[init_args.index("raster") + 2 :]
     else:
@@ -206,19 +392,36 @@ def assign_by_raster_value(k, run, context, _):
             "The values and assignments don't pair up in %s:assign_by_raster_value", k
         )
         return None
-    if context[k] in raster_val:
-        rv_idx = raster_val.index(context[k])
-        return {k: assignment[rv_idx]}
+    assignments = {}
+    for rv, a in zip(raster_val, assignment):
+        assignments.setdefault(rv, a)
+    return assignments
+
+
+def assign_by_raster_value(k, run, context, _, args=None):
+    if args is None:
+        args = _parse_assign_args(k, run[k])
+        if args is None:
+            return None
+    if context[k] in args:
+        return {k: args[context[k]]}
     else:
         logging.error("No assignment for value %d in %s:assign_by_value", context[k], k)
         return None
 
 
-def date_from_doy_raster(k, run, context, _):
-    init_args = run[k].split("::")[1:]
-    if "raster" not in init_args:
+def _parse_doy_raster_args(k, spec):
+    if "raster" not in _args(spec):
         logging.error("date_from_doy_raster: No raster specified.")
         return None
+    return True
+
+
+def date_from_doy_raster(k, run, context, _, args=None):
+    if args is None:
+        args = _parse_doy_raster_args(k, run[k])
+        if args is None:
+            return None
     if context[k] < 1 or context[k] > 366:
         logging.error(
             "date_from_doy_raster: Invalid day of year found in raster: %d", context[k]
@@ -231,8 +434,8 @@ def date_from_doy_raster(k, run, context, _):
     }
 
 
-def date_offset(k, run, context, _):
-    args = run[k].split("::")[1:]
+def _parse_date_offset_args(k, spec):
+    args = _args(spec)
     offset_value = args[-1]
     try:
         offset_value = int(offset_value)
@@ -240,20 +443,151 @@ def date_offset(k, run, context, _):
         logging.error("date_offset: %s is not an integer", offset_value)
         return None
     if args[0].startswith("$"):
-        search_context = args[0][1:]
-        if search_context not in context:
-            logging.error("date_offset: %s is not in the current context.", args[0])
-            return None
-        context_date = context[search_context]
-        cxt_date = pythia.util.from_iso_date(context_date)
-        td = datetime.timedelta(days=offset_value)
-        new_date = cxt_date + td
-        return {k: pythia.util.to_iso_date(new_date)}
+        return args[0][1:], offset_value
     else:
         logging.error("date_offset only works with references variables.")
         return None
 
 
+def date_offset(k, run, context, _, args=None):
+    if args is None:
+        args = _parse_date_offset_args(k, run[k])
+        if args is None:
+            return None
+    search_context, offset_value = args
+    if search_context not in context:
+        logging.error("date_offset: $%s is not in the current context.", search_context)
+        return None
+    context_date = context[search_context]
+    cxt_date = pythia.util.from_iso_date(context_date)
+    td = datetime.timedelta(days=offset_value)
+    new_date = cxt_date + td
+    return {k: pythia.util.to_iso_date(new_date)}
+
+
+def _scatter(results, inverse, n):
+    """Expand results computed once per distinct value into columns of n rows."""
+    valid = np.array([r is not None for r in results], dtype=bool)[inverse]
+    outputs = {}
+    for idx, result in enumerate(results):
+        if result is None:
+            continue
+        for key, value in result.items():
+            if key not in outputs:
+                outputs[key] = np.empty(len(results), dtype=object)
+            outputs[key][idx] = value
+    return {key: column[inverse] for key, column in outputs.items()}, valid
+
+
+def _batch_by_value(fn):
+    """Batch form of a function which only depends on the raster value of its
+    key. The function runs once per distinct value, with the context of the
+    first pixel holding that value."""
+
+    def batch(k, run, columns, config, args):
+        n = len(columns["lat"])
+        if n == 0:
+            return {}, np.zeros(0, dtype=bool)
+        if k in columns:
+            _, first, inverse = np.unique(
+                columns[k], return_index=True, return_inverse=True
+            )
+        else:
+            first = [0]
+            inverse = np.zeros(n, dtype=np.int64)
+        results = []
+        for idx in first:
+            context = {**run, **{key: col[idx] for key, col in columns.items()}}
+            results.append(fn(k, run, context, config, args))
+        return _scatter(results, inverse, n)
+
+    return batch
+
+
+def _batch_by_closest_vector(vector, attr, columns, config, fn):
+    """Look up the closest vector point of every pixel at once, then run fn once
+    per distinct attribute value."""
+    n = len(columns["lat"])
+    if n == 0:
+        return {}, np.zeros(0, dtype=bool)
+    ids = pythia.io.find_closest_vector_coords_batch(
+        vector,
+        columns["lng"],
+        columns["lat"],
+        attr,
+        config.get("vectorSidecar", False),
+    )
+    values, inverse = np.unique(np.asarray(ids), return_inverse=True)
+    return _scatter([fn(v) for v in values], inverse, n)
+
+
+def lookup_wth_batch(k, run, columns, config, args):
+    wsta, vector, attr = args
+    return _batch_by_closest_vector(
+        vector,
+        attr,
+        columns,
+        config,
+        lambda cell_id: {k: wsta, "wthFile": "{}.WTH".format(int(cell_id))},
+    )
+
+
+def auto_planting_window_doy_shape_batch(k, run, columns, config, args):
+    vector, attr, offset, window = args
+
+    def planting_window(cell_doy):
+        first = datetime.datetime(run["startYear"], 1, 1) + datetime.timedelta(
+            int(cell_doy) + offset
+        )
+        last = first + datetime.timedelta(days=window)
+        return {
+            "pdate": pythia.util.to_iso_date(first),
+            "pfrst": pythia.util.to_iso_date(first),
+            "plast": pythia.util.to_iso_date(last),
+        }
+
+    return _batch_by_closest_vector(vector, attr, columns, config, planting_window)
+
+
+def _column(k, run, columns):
+    if k in columns:
+        return columns[k]
+    column = np.empty(len(columns["lat"]), dtype=object)
+    column.fill(run[k])
+    return column
+
+
+def generate_ic_layers_batch(k, run, columns, config, args):
+    """The layers are computed once per distinct profile, all profiles at once
+    with the matrix version of the layer math."""
+    n = len(columns["lat"])
+    if n == 0:
+        return {}, np.zeros(0, dtype=bool)
+    persist = config.get("soilIndexSidecar", False)
+    profiles = _column(args, run, columns)
+    soil_files = _column("soilFiles", run, columns)
+    _, first, inverse = np.unique(
+        profiles.astype(str), return_index=True, return_inverse=True
+    )
+    soil_datas = []
+    for idx in first:
+        soil_file = pythia.soil_handler.findSoilProfile(
+            profiles[idx], soil_files[idx], persist
+        )
+        soil_datas.append(
+            pythia.soil_handler.cachedSoilLayers(profiles[idx], soil_file, persist)
+        )
+    calculated = pythia.soil_handler.calculateICLayerDataMatrix(
+        soil_datas, run["icin"], run["icsw%"]
+    )
+    layer_labels = ["icbl", "sh2o", "snh4", "sno3"]
+    results = [
+        {k: [dict(zip(layer_labels, cl)) for cl in calculated_layers]}
+        for calculated_layers in calculated
+    ]
+    return _scatter(results, inverse, n)
+
+
 def string_to_number(term):
     try:
         if "." in term:
@@ -263,3 +597,58 @@ def string_to_number(term):
     except ValueError:
         logging.error("string_to_number: %s is not a number", term)
         return None
+
+
+# Parse the arguments of a function spec ahead of time, see pythia.compiler. The
+# parsed arguments are passed to the function as args, a parser returning None
+# marks an invalid spec.
+arg_parsers = {
+    "auto_planting_window": _parse_window_args,
+    "auto_planting_window_doy": _parse_window_args,
+    "auto_planting_window_doy_shape": _parse_window_shape_args,
+    "lookup_hc27": _parse_hc27_args,
+    "lookup_wth": _parse_wth_args,
+    "generate_ic_layers": _parse_reference,
+    "lookup_ghr": _parse_raster_flag,
+    "split_fert_dap_percent": _parse_split_fert_args,
+    "assign_by_raster_value": _parse_assign_args,
+    "date_from_doy_raster": _parse_doy_raster_args,
+    "date_offset": _parse_date_offset_args,
+}
+
+# Context keys each function writes besides its own key, and reads besides the
+# $references in its spec. Used to order the evaluation, see pythia.compiler.
+function_provides = {
+    "auto_planting_window": ["pdate", "pfrst", "plast"],
+    "auto_planting_window_doy": ["pdate", "pfrst", "plast"],
+    "auto_planting_window_doy_shape": ["pdate", "pfrst", "plast"],
+    "lookup_wth": ["wthFile"],
+    "lookup_ghr": ["soilFiles"],
+}
+
+function_requires = {
+    "generate_ic_layers": ["soilFiles"],
+}
+
+# Functions which do file I/O per pixel run after the cheap ones, so a pixel
+# failing a cheap function is skipped before the expensive ones run.
+function_costs = {
+    "auto_planting_window_doy_shape": 1,
+    "lookup_wth": 1,
+    "generate_ic_layers": 2,
+}
+
+# Batch forms of the functions, evaluated over the columns of a whole run at once
+# instead of once per pixel. A batch function returns the output columns and a
+# boolean array which is False for the pixels to skip.
+batch_functions = {
+    "auto_planting_window": _batch_by_value(auto_planting_window),
+    "auto_planting_window_doy": _batch_by_value(auto_planting_window_doy),
+    "auto_planting_window_doy_shape": auto_planting_window_doy_shape_batch,
+    "lookup_hc27": _batch_by_value(lookup_hc27),
+    "lookup_wth": lookup_wth_batch,
+    "lookup_ghr": _batch_by_value(lookup_ghr),
+    "assign_by_raster_value": _batch_by_value(assign_by_raster_value),
+    "date_from_doy_raster": _batch_by_value(date_from_doy_raster),
+    "generate_ic_layers": generate_ic_layers_batch,
+}
@@ -1,11 +1,15 @@
+import hashlib
+import logging
 import os
 
 import fiona
+import numpy as np
 import numpy.ma as ma
 import rasterio
-from shapely.geometry import Point, MultiPoint
-from shapely.ops import nearest_points
+from rasterio.windows import Window
+import rtree.index
 
+from pythia.cache_manager import cache
 import pythia.functions
 import pythia.util
 
@@ -26,41 +30,197 @@ def get_site_raster_value(dataset, band, site):
     return data
 
 
-def peer(run, sample_size=None):
-    rasters = pythia.util.get_rasters_dict(run)
-    sites = []
-    if isinstance(run["sites"], list):
-        sites = pythia.functions.xy_from_list(run["sites"])
-    else:
-        sites = pythia.functions.xy_from_vector(run["sites"])
-    data = []
-    layers = list(rasters.keys())
-    for raster in rasters.values():
+def site_arrays(sites):
+    """Split a list of (lng, lat) sites into coordinate arrays."""
+    coords = np.asarray(sites, dtype=np.float64).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+
+def index_sites(dataset, xs, ys):
+    """Vectorized dataset.index: converts all the site coordinates into row/col
+    arrays in one pass using the inverse affine transform."""
+    cols, rows = ~dataset.transform * (xs, ys)
+    return np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+
+
+def _in_bounds(dataset, rows, cols):
+    return (rows >= 0) & (rows < dataset.height) & (cols >= 0) & (cols < dataset.width)
+
+
+def read_sites(dataset, rows, cols, windowed=False, bidx=1):
+    """Gather the band values at rows/cols with fancy indexing. Returns the
+    values and a boolean array which is True where the value is masked or the
+    site is out of bounds.
+
+    In windowed mode, only the internal blocks holding a site are read. Sites
+    are grouped by block so each block is read at most once."""
+    values = np.zeros(len(rows), dtype=dataset.dtypes[bidx - 1])
+    mask = ~_in_bounds(dataset, rows, cols)
+    inside = np.flatnonzero(~mask)
+    if not windowed:
+        band = dataset.read(bidx, masked=True)
+        values[inside] = band.data[rows[inside], cols[inside]]
+        mask[inside] = ma.getmaskarray(band)[rows[inside], cols[inside]]
+        return values, mask
+    block_h, block_w = dataset.block_shapes[bidx - 1]
+    block_ids = (rows[inside] // block_h) * -(-dataset.width // block_w) + (
+        cols[inside] // block_w
+    )
+    order = np.argsort(block_ids, kind="stable")
+    splits = np.flatnonzero(np.diff(block_ids[order])) + 1
+    for group in np.split(inside[order], splits):
+        if len(group) == 0:
+            continue
+        row_off = (rows[group[0]] // block_h) * block_h
+        col_off = (cols[group[0]] // block_w) * block_w
+        window = Window(
+            col_off,
+            row_off,
+            min(block_w, dataset.width - col_off),
+            min(block_h, dataset.height - row_off),
+        )
+        block = dataset.read(bidx, window=window, masked=True)
+        block_rows = rows[group] - row_off
+        block_cols = cols[group] - col_off
+        values[group] = block.data[block_rows, block_cols]
+        mask[group] = ma.getmaskarray(block)[block_rows, block_cols]
+    return values, mask
+
+
+def _sites_key(xs, ys):
+    return hashlib.sha1(xs.tobytes() + ys.tobytes()).hexdigest()
+
+
+def sample_raster(raster, xs, ys, windowed=False):
+    """Sample a raster at the given sites. Samples are cached by raster path and
+    site set, so runs sharing the same rasters and sites only read them once."""
+    samples = cache.setdefault("raster_samples", {})
+    key = (os.path.abspath(raster), _sites_key(xs, ys))
+    if key not in samples:
         with rasterio.open(raster) as ds:
-            band = ds.read(1, masked=True)
-            data.append([get_site_raster_value(ds, band, site) for site in sites])
-    peerless = list(
-        filter(
-            lambda x: x is not None,
-            [read_layer_by_cell(i, data, layers, sites) for i in range(len(sites))],
+            rows, cols = index_sites(ds, xs, ys)
+            samples[key] = read_sites(ds, rows, cols, windowed)
+    return samples[key]
+
+
+def get_sites(run, sidecar=False):
+    """Site coordinate arrays of a run. Vector sites share the parsed copy of
+    the file with the attribute lookups."""
+    if isinstance(run["sites"], list):
+        return site_arrays(pythia.functions.xy_from_list(run["sites"]))
+    layer = load_vector_layer(run["sites"].split("::")[1], sidecar)
+    first = layer.first_points()
+    return layer.xs[first], layer.ys[first]
+
+
+def clear_sample_cache():
+    cache.pop("raster_samples", None)
+
+
+class PeerResult:
+    """The sampled raster values of a run. Layer values and their mask state
+    are kept in structured arrays, one record per site, and the per-pixel
+    dictionaries are only built when they are requested. computed holds the
+    columns of the functions evaluated in batch, see pythia.compiler."""
+
+    def __init__(self, xs, ys, layers, values, mask, index, computed=None):
+        self.xs = xs
+        self.ys = ys
+        self.layers = layers
+        self.values = values
+        self.mask = mask
+        self.index = index
+        self.computed = computed or {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for idx in self.index:
+            yield self.cell(idx)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.select(self.index[item])
+        return self.cell(self.index[item])
+
+    def select(self, index, computed=None):
+        return PeerResult(
+            self.xs,
+            self.ys,
+            self.layers,
+            self.values,
+            self.mask,
+            index,
+            self.computed if computed is None else computed,
         )
+
+    def cell(self, idx):
+        lng = self.xs[idx].item()
+        lat = self.ys[idx].item()
+        cell = {"lat": lat, "lng": lng, "xcrd": lng, "ycrd": lat}
+        record = self.values[idx]
+        for layer in self.layers:
+            cell[layer] = record[layer]
+        for key, column in self.computed.items():
+            cell[key] = column[idx]
+        return cell
+
+    def columns(self):
+        """The cells as columns, one array per key."""
+        lng = self.xs[self.index]
+        lat = self.ys[self.index]
+        columns = {"lat": lat, "lng": lng, "xcrd": lng, "ycrd": lat}
+        for layer in self.layers:
+            columns[layer] = self.values[layer][self.index]
+        for key, column in self.computed.items():
+            columns[key] = column[self.index]
+        return columns
+
+    def with_columns(self, columns, valid):
+        """Keep the cells where valid is True, adding the computed columns."""
+        computed = dict(self.computed)
+        for key, column in columns.items():
+            full = np.empty(len(self.xs), dtype=column.dtype)
+            full[self.index] = column
+            computed[key] = full
+        return self.select(self.index[valid], computed)
+
+
+def _mask_layers(run, layers):
+    masks = ["harvestArea"] + run.get("maskLayers", [])
+    return [layer for layer in layers if layer in masks]
+
+
+def peer(run, sample_size=None, config=None):
+    config = config or {}
+    rasters = pythia.util.get_rasters_dict(run)
+    xs, ys = get_sites(run, config.get("vectorSidecar", False))
+    layers = list(rasters.keys())
+    windowed = config.get("windowedSampling", False)
+
+    # Sample the masking layers first, every other raster is only read at the
+    # sites which are still valid.
+    mask_layers = _mask_layers(run, layers)
+    ordered = mask_layers + [layer for layer in layers if layer not in mask_layers]
+    sampled = {}
+    surviving = np.arange(len(xs))
+    for layer in ordered:
+        v, m = sample_raster(rasters[layer], xs[surviving], ys[surviving], windowed)
+        sampled[layer] = (surviving, v, m)
+        keep = ~m
+        if layer in mask_layers:
+            keep &= v != 0
+        surviving = surviving[keep]
+
+    values = np.zeros(
+        len(xs), dtype=[(layer, sampled[layer][1].dtype) for layer in layers]
     )
-    return peerless[:sample_size]
-
-
-def read_layer_by_cell(idx, data, layers, sites):
-    if data is None:
-        return None
-    lng, lat = sites[idx]
-    cell = {"lat": lat, "lng": lng, "xcrd": lng, "ycrd": lat}
-    for i, c in enumerate(data):
-        if c[idx] is None:
-            return None
-        if layers[i] == "harvestArea" and c[idx] == 0:
-            return None
-        else:
-            cell[layers[i]] = c[idx]
-    return cell
+    mask = np.ones(len(xs), dtype=[(layer, np.bool_) for layer in layers])
+    for layer, (idx, v, m) in sampled.items():
+        values[layer][idx] = v
+        mask[layer][idx] = m
+    return PeerResult(xs, ys, layers, values, mask, surviving[:sample_size])
 
 
 def make_run_directory(rd):
@@ -77,50 +237,250 @@ def get_shp_profile(f):
     pass
 
 
-def extract_vector_coords(f):
-    points = []
-    with fiona.open(f, "r") as source:
-        for feature in source:
-            if feature["geometry"]["type"] == "MultiPoint":
-                points.append(feature["geometry"]["coordinates"][0])
-            if feature["geometry"]["type"] == "Point":
-                points.append(feature["geometry"]["coordinates"])
-    return points
-
-
-def find_vector_coords(f, lng, lat, a):
-    coords = (lng, lat)
-    with fiona.open(f, "r") as source:
-        for feature in source:
-            if feature["geometry"]["type"] == "MultiPoint":
-                if coords in feature["geometry"]["coordinates"]:
-                    return feature["properties"][a]
-            if feature["geometry"]["type"] == "Point":
-                if coords == feature["geometry"]["coordinates"]:
-                    return feature["properties"][a]
-
-
-def find_closest_vector_coords(f, lng, lat, a):
-    coords = Point(lng, lat)
-    points = []
-    ids = []
-    with fiona.open(f, "r") as source:
-        for feature in source:
-            if feature["geometry"]["type"] == "MultiPoint":
-                points.extend(
-                    [Point(p[0], p[1]) for p in feature["geometry"]["coordinates"]]
-                )
-                ids.extend(
-                    [feature["properties"][a]] * len(feature["geometry"]["coordinates"])
-                )
-            if feature["geometry"]["type"] == "Point":
-                points.append(
-                    Point(
-                        feature["geometry"]["coordinates"][0],
-                        feature["geometry"]["coordinates"][1],
-                    )
-                )
-                ids.append(feature["properties"][a])
-    mp = MultiPoint(points)
-    nearest = nearest_points(coords, mp)[1]
-    return ids[points.index(nearest)]
+class VectorLayer:
+    """A point vector file loaded into coordinate arrays and attribute columns.
+    Multipoint features contribute all of their points; feature holds the
+    feature index of every point."""
+
+    def __init__(self, xs, ys, feature, attributes):
+        self.xs = xs
+        self.ys = ys
+        self.feature = feature
+        self.attributes = attributes
+        self._points = None
+
+    @classmethod
+    def from_file(cls, f):
+        xs = []
+        ys = []
+        feature = []
+        properties = []
+        with fiona.open(f, "r") as source:
+            for feat in source:
+                if feat["geometry"]["type"] == "MultiPoint":
+                    coords = feat["geometry"]["coordinates"]
+                elif feat["geometry"]["type"] == "Point":
+                    coords = [feat["geometry"]["coordinates"]]
+                else:
+                    continue
+                for p in coords:
+                    xs.append(p[0])
+                    ys.append(p[1])
+                    feature.append(len(properties))
+                properties.append(dict(feat["properties"]))
+            names = list(source.schema["properties"].keys())
+        attributes = {n: np.asarray([p.get(n) for p in properties]) for n in names}
+        return cls(
+            np.asarray(xs, dtype=np.float64),
+            np.asarray(ys, dtype=np.float64),
+            np.asarray(feature, dtype=np.int64),
+            attributes,
+        )
+
+    @classmethod
+    def from_sidecar(cls, sidecar):
+        with np.load(sidecar, allow_pickle=True) as data:
+            attributes = {
+                k[len("attr_") :]: data[k] for k in data.files if k.startswith("attr_")
+            }
+            return cls(data["xs"], data["ys"], data["feature"], attributes)
+
+    def save(self, sidecar):
+        np.savez(
+            sidecar,
+            xs=self.xs,
+            ys=self.ys,
+            feature=self.feature,
+            **{"attr_{}".format(k): v for k, v in self.attributes.items()},
+        )
+
+    def first_points(self):
+        """Index of the first point of every feature."""
+        return np.flatnonzero(np.diff(self.feature, prepend=-1) != 0)
+
+    def sites(self):
+        first = self.first_points()
+        return list(zip(self.xs[first].tolist(), self.ys[first].tolist()))
+
+    def point_attribute(self, a):
+        """The values of an attribute for every point."""
+        return self.attributes[a][self.feature]
+
+    def attribute(self, a, point_idx):
+        value = self.attributes[a][self.feature[point_idx]]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def find(self, lng, lat):
+        """Index of the first point exactly at lng/lat, or None."""
+        if self._points is None:
+            self._points = {}
+            for idx, coords in enumerate(zip(self.xs.tolist(), self.ys.tolist())):
+                self._points.setdefault(coords, idx)
+        return self._points.get((lng, lat))
+
+
+def _sidecar_path(f):
+    return "{}.pythia.npz".format(f)
+
+
+def _source_mtime(f):
+    mtime = os.path.getmtime(f)
+    dbf = "{}.dbf".format(os.path.splitext(f)[0])
+    if os.path.exists(dbf):
+        mtime = max(mtime, os.path.getmtime(dbf))
+    return mtime
+
+
+def load_vector_layer(f, sidecar=False):
+    """Load a vector file once per process. A sidecar next to the file is used
+    when it is newer than the file, and written when sidecar is True."""
+    layers = cache.setdefault("vector_layers", {})
+    key = os.path.abspath(f)
+    if key not in layers:
+        sidecar_file = _sidecar_path(f)
+        fresh = os.path.exists(sidecar_file) and (
+            os.path.getmtime(sidecar_file) >= _source_mtime(f)
+        )
+        if fresh:
+            layers[key] = VectorLayer.from_sidecar(sidecar_file)
+        else:
+            layers[key] = VectorLayer.from_file(f)
+            if sidecar:
+                try:
+                    layers[key].save(sidecar_file)
+                except OSError:
+                    logging.warning("Unable to write vector sidecar %s", sidecar_file)
+    return layers[key]
+
+
+def extract_vector_coords(f, sidecar=False):
+    return load_vector_layer(f, sidecar).sites()
+
+
+def find_vector_coords(f, lng, lat, a, sidecar=False):
+    layer = load_vector_layer(f, sidecar)
+    idx = layer.find(lng, lat)
+    if idx is not None:
+        return layer.attribute(a, idx)
+
+
+class NearestIndex:
+    """R-tree index over the points of a vector file, used to find the value of
+    an attribute at the closest point. Ties are resolved to the first point in
+    the file. The points are also bucketed in a grid of about one point per
+    cell, for the bulk queries of nearest_batch."""
+
+    def __init__(self, xs, ys, ids):
+        self.xs = np.asarray(xs, dtype=np.float64)
+        self.ys = np.asarray(ys, dtype=np.float64)
+        self.ids = ids
+        self.index = rtree.index.Index(
+            (i, (x, y, x, y), None)
+            for i, (x, y) in enumerate(zip(self.xs.tolist(), self.ys.tolist()))
+        )
+        self.x0 = self.xs.min() if len(self.xs) else 0.0
+        self.y0 = self.ys.min() if len(self.ys) else 0.0
+        extent = 0.0
+        if len(self.xs):
+            extent = max(self.xs.max() - self.x0, self.ys.max() - self.y0)
+        self.cell = extent / max(1, int(np.sqrt(len(self.xs)))) or 1.0
+        cols, rows = self._cells(self.xs, self.ys)
+        self.shape = (
+            int(cols.max()) + 1 if len(cols) else 1,
+            int(rows.max()) + 1 if len(rows) else 1,
+        )
+        keys = cols * self.shape[1] + rows
+        # The points of each cell, in file order
+        self.order = np.argsort(keys, kind="stable")
+        self.starts = np.searchsorted(
+            keys[self.order], np.arange(self.shape[0] * self.shape[1] + 1)
+        )
+
+    def _cells(self, xs, ys):
+        return (
+            np.floor((xs - self.x0) / self.cell).astype(np.int64),
+            np.floor((ys - self.y0) / self.cell).astype(np.int64),
+        )
+
+    def _value(self, i):
+        value = self.ids[i]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def nearest(self, lng, lat):
+        return self._value(min(self.index.nearest((lng, lat, lng, lat), 1)))
+
+    def _nearest_in_cells(self, lngs, lats, radius):
+        """The nearest point to each query among the points in the cells at
+        most radius cells away from its own, with its distance."""
+        best = np.full(len(lngs), -1, dtype=np.int64)
+        best_dists = np.full(len(lngs), np.inf)
+        steps = np.arange(-radius, radius + 1)
+        cols, rows = self._cells(lngs, lats)
+        cols = (cols[:, None] + np.repeat(steps, len(steps))[None, :]).ravel()
+        rows = (rows[:, None] + np.tile(steps, len(steps))[None, :]).ravel()
+        inside = (cols >= 0) & (cols < self.shape[0]) & (rows >= 0)
+        inside &= rows < self.shape[1]
+        keys = np.where(inside, cols * self.shape[1] + rows, 0)
+        starts = self.starts[keys]
+        counts = np.where(inside, self.starts[keys + 1] - starts, 0)
+        # The points of the cells around each query, query after query
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        points = self.order[np.repeat(starts, counts) + offsets]
+        found = counts.reshape(len(lngs), -1).sum(axis=1)
+        queries = np.repeat(np.arange(len(lngs)), found)
+        if len(queries) == 0:
+            return best, best_dists
+        # Same distance as the index computes, to find the same ties
+        dists = np.sqrt(
+            (self.xs[points] - lngs[queries]) ** 2
+            + (self.ys[points] - lats[queries]) ** 2
+        )
+        groups = (np.cumsum(found) - found)[found > 0]
+        nearest = np.minimum.reduceat(dists, groups)
+        tied = dists == np.repeat(nearest, found[found > 0])
+        first = np.where(tied, points, np.iinfo(np.int64).max)
+        best[found > 0] = np.minimum.reduceat(first, groups)
+        best_dists[found > 0] = nearest
+        return best, best_dists
+
+    def nearest_batch(self, lngs, lats, radii=(1, 2, 4)):
+        """The nearest of many points, found with bulk queries of the grid
+        cells around them. A point closer than radius cells to every query is
+        the nearest one, the other queries are retried with the next radius
+        and with nearest after the last one."""
+        lngs = np.asarray(lngs, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        results = np.full(len(lngs), -1, dtype=np.int64)
+        left = np.arange(len(lngs))
+        for radius in radii:
+            if len(left) == 0 or len(self.xs) == 0:
+                break
+            best, dists = self._nearest_in_cells(lngs[left], lats[left], radius)
+            # Leave a margin for the rounding of the cell of a point
+            found = dists < radius * self.cell * (1 - 1e-9)
+            results[left[found]] = best[found]
+            left = left[~found]
+        values = [self._value(i) for i in results.tolist()]
+        for i in left.tolist():
+            values[i] = self.nearest(lngs[i], lats[i])
+        return values
+
+
+def get_nearest_index(f, a, sidecar=False):
+    """The NearestIndex of a vector file and attribute, built once per process."""
+    indexes = cache.setdefault("nearest_index", {})
+    key = (os.path.abspath(f), a)
+    if key not in indexes:
+        layer = load_vector_layer(f, sidecar)
+        indexes[key] = NearestIndex(layer.xs, layer.ys, layer.point_attribute(a))
+    return indexes[key]
+
+
+def find_closest_vector_coords(f, lng, lat, a, sidecar=False):
+    return get_nearest_index(f, a, sidecar).nearest(lng, lat)
+
+
+def find_closest_vector_coords_batch(f, lngs, lats, a, sidecar=False):
+    return get_nearest_index(f, a, sidecar).nearest_batch(lngs, lats)
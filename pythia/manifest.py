@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+
+
+def manifest_path(config):
+    return os.path.join(config["workDir"], ".pythia_manifest.db")
+
+
+def open_manifest(config):
+    """The manifest of the last setup, or None when there is none."""
+    path = manifest_path(config)
+    if not os.path.exists(path):
+        return None
+    return Manifest(path)
+
+
+def context_hash(context, salt=""):
+    """A digest of everything a pixel directory is rendered from. The sites of
+    the run are left out, they are the same for every pixel."""
+    h = hashlib.sha1(salt.encode())
+    h.update(
+        json.dumps(
+            {k: v for k, v in context.items() if k != "sites"},
+            sort_keys=True,
+            default=str,
+        ).encode()
+    )
+    return h.hexdigest()
+
+
+class Manifest:
+    """The pixel directories written by the setup, with their run, X file,
+    coordinates, sampled attributes and the hash of the context each one was
+    rendered from. Every setup is a new generation, the pixels not
+    recorded in the current generation are the ones which dropped out.
+
+    The records are buffered and only written by the process calling flush, the
+    setup workers only read from the manifest."""
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = None
+        self.pending = []
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pixels ("
+                "dir TEXT PRIMARY KEY, run TEXT, xfile TEXT, hash TEXT, "
+                "generation INTEGER, lat REAL, lng REAL, attributes TEXT)"
+            )
+            columns = {
+                row[1] for row in self._conn.execute("PRAGMA table_info(pixels)")
+            }
+            for column, kind in [
+                ("lat", "REAL"),
+                ("lng", "REAL"),
+                ("attributes", "TEXT"),
+            ]:
+                if column not in columns:
+                    self._conn.execute(
+                        "ALTER TABLE pixels ADD COLUMN {} {}".format(column, kind)
+                    )
+            self._conn.commit()
+        return self._conn
+
+    def begin(self):
+        (last,) = self.conn.execute("SELECT MAX(generation) FROM pixels").fetchone()
+        self.generation = (last or 0) + 1
+        return self.generation
+
+    def previous_hash(self, path):
+        row = self.conn.execute(
+            "SELECT hash FROM pixels WHERE dir = ?", (path,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, path, run, xfile, digest, lat=None, lng=None, attributes=None):
+        self.pending.append(
+            (path, run, xfile, digest, lat, lng, json.dumps(attributes or {}))
+        )
+
+    def take(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def flush(self, records=None):
+        if records is None:
+            records = self.take()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO pixels "
+            "(dir, run, xfile, hash, lat, lng, attributes, generation) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(*r, self.generation) for r in records],
+        )
+        self.conn.commit()
+
+    def move(self, path, target):
+        """Record the pixel of path under target instead, replacing the record
+        of a previous generation there."""
+        self.conn.execute(
+            "UPDATE OR REPLACE pixels SET dir = ? WHERE dir = ?", (target, path)
+        )
+        self.conn.commit()
+
+    def stale(self, runs=None):
+        """The pixels of the previous generations, only of the given runs when
+        runs is set. The pixels of the other runs are left to their own
+        setups."""
+        query = "SELECT dir FROM pixels WHERE generation < ?"
+        params = (self.generation,)
+        if runs is not None:
+            runs = list(runs)
+            query += " AND run IN ({})".format(", ".join("?" * len(runs)))
+            params += tuple(runs)
+        return [row[0] for row in self.conn.execute(query, params)]
+
+    def drop_stale(self, remove=False, runs=None):
+        """Forget the stale pixels, removing their directories too when remove
+        is True."""
+        stale = self.stale(runs)
+        if remove:
+            for path in stale:
+                logging.info("[MANIFEST] Removing dropped pixel %s", path)
+                shutil.rmtree(path, ignore_errors=True)
+        self.conn.executemany(
+            "DELETE FROM pixels WHERE dir = ?", [(path,) for path in stale]
+        )
+        self.conn.commit()
+        return stale
+
+    def entries(self, run=None):
+        query = "SELECT dir, run, xfile, lat, lng, attributes FROM pixels"
+        params = ()
+        if run is not None:
+            query += " WHERE run = ?"
+            params = (run,)
+        for row in self.conn.execute(query + " ORDER BY dir", params):
+            yield {
+                "dir": row[0],
+                "run": row[1],
+                "xfile": row[2],
+                "lat": row[3],
+                "lng": row[4],
+                "attributes": json.loads(row[5] or "{}"),
+            }
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -1,32 +1,37 @@
 import logging
 import multiprocessing as mp
 import concurrent.futures
+import hashlib
+import math
 import os
+import shutil
 
+import pythia.compiler
 import pythia.functions
 import pythia.io
+import pythia.manifest
 import pythia.plugin
+import pythia.soil_handler
 import pythia.template
 import pythia.util
 
 
-def build_context(run, ctx, config, plugins):
+def build_context(run, ctx, config, plugins, functions=None):
     if not config["silence"]:
         print("+", end="", flush=True)
+    if functions is None:
+        functions = pythia.compiler.compile_run(run)
     context = run.copy()
     context = {**context, **ctx}
     y, x = pythia.util.translate_coords_news(context["lat"], context["lng"])
     context["contextWorkDir"] = os.path.join(context["workDir"], y, x)
-    for k, v in run.items():
-        if "::" in str(v) and k != "sites":
-            fn = v.split("::")[0]
-            if fn != "raster":
-                res = getattr(pythia.functions, fn)(k, run, context, config)
-                if res is not None:
-                    context = {**context, **res}
-                else:
-                    context = None
-                    break
+    for fn in functions:
+        res = fn(run, context, config)
+        if res is not None:
+            context = {**context, **res}
+        else:
+            context = None
+            break
 
     hook = pythia.plugin.PluginHook.post_peerless_pixel_success
     if context is None:
@@ -42,32 +47,228 @@ def build_context(run, ctx, config, plugins):
     return context
 
 
-def _generate_context_args(runs, peers, config, plugins):
-    for idx, run in enumerate(runs):
-        for peer in peers[idx]:
-            yield run, peer, config, plugins
+def _skip_batch_pixels(run, skipped, config, plugins):
+    hook = pythia.plugin.PluginHook.post_peerless_pixel_skip
+    if hook not in plugins:
+        return
+    for ctx in skipped:
+        pythia.plugin.run_plugin_functions(
+            hook,
+            plugins,
+            context=None,
+            args={"run": run, "config": config, "ctx": ctx},
+        )
+
+
+# State shared by every task of a setup worker, set once by _init_worker so the
+# tasks only carry the pixel ranges to build.
+_worker = {}
+
+
+def _init_worker(config, plugins, runs, peers, compiled, manifest_path):
+    _worker["config"] = config
+    _worker["plugins"] = plugins
+    _worker["runs"] = runs
+    _worker["peers"] = peers
+    _worker["compiled"] = compiled
+    if "soilCacheSize" in config:
+        pythia.soil_handler.setSoilCacheSize(config["soilCacheSize"])
+    # A forked worker starts with the counters of the parent, which are logged
+    #  by the parent itself.
+    _soil_cache_delta()
+    if config.get("parallelCompose", False):
+        _worker["env"] = pythia.template.init_engine(
+            config["templateDir"], pythia.template.bytecode_cache_dir(config)
+        )
+        _worker["manifest"] = pythia.manifest.Manifest(manifest_path)
+
+
+def _soil_cache_delta():
+    """The soil cache hits and misses of this worker since its last chunk."""
+    last = _worker.get("soil_cache", {})
+    counts = {
+        k: (info.hits, info.misses)
+        for k, info in pythia.soil_handler.soilCacheInfo().items()
+    }
+    _worker["soil_cache"] = counts
+    return {
+        k: (hits - last.get(k, (0, 0))[0], misses - last.get(k, (0, 0))[1])
+        for k, (hits, misses) in counts.items()
+    }
+
+
+def _build_context_chunk(run_idx, start, stop):
+    """Build the contexts of a range of pixels of a run. Returns them, or with
+    parallelCompose the run directories and manifest records, along with the
+    soil cache counters of the chunk."""
+    run = _worker["runs"][run_idx]
+    contexts = [
+        build_context(
+            run,
+            ctx,
+            _worker["config"],
+            _worker["plugins"],
+            _worker["compiled"][run_idx],
+        )
+        for ctx in _worker["peers"][run_idx][start:stop]
+    ]
+    if "env" not in _worker:
+        return contexts, _soil_cache_delta()
+    # With parallelCompose the contexts are processed here and only the
+    #  resulting run directories and their manifest records are sent back.
+    results = [
+        process_context(
+            context,
+            _worker["plugins"],
+            _worker["config"],
+            _worker["env"],
+            _worker["manifest"],
+        )
+        for context in contexts
+        if context is not None
+    ]
+    return (results, _worker["manifest"].take()), _soil_cache_delta()
+
+
+def _generate_chunks(peers, chunk_size):
+    for idx, peer in enumerate(peers):
+        for start in range(0, len(peer), chunk_size):
+            yield idx, start, min(start + chunk_size, len(peer))
+
+
+def _bounded_submit(executor, fn, tasks, max_in_flight):
+    """Submit ``fn(*task)`` for every task, keeping at most ``max_in_flight``
+    futures pending, and yield the futures as they complete."""
+    tasks = iter(tasks)
+    pending = set()
+    while True:
+        for task in tasks:
+            pending.add(executor.submit(fn, *task))
+            if len(pending) >= max_in_flight:
+                break
+        if not pending:
+            return
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        yield from done
+
+
+# Input files known to exist and files already placed in the input stores, per
+# process, so the pixel loop does not stat them for every pixel.
+_existing_inputs = {}
+_stored_inputs = set()
+
+
+def _input_exists(path):
+    if path not in _existing_inputs:
+        _existing_inputs[path] = os.path.exists(path)
+    return _existing_inputs[path]
+
+
+def _store_input(store_dir, source):
+    """Place source once in the run input store and return its path there. The
+    store is inside the workDir so the pixel directories can hardlink to it."""
+    source = os.path.abspath(source)
+    key = hashlib.md5(source.encode()).hexdigest()[:16]
+    stored = os.path.join(store_dir, "{}_{}".format(key, os.path.basename(source)))
+    if stored in _stored_inputs:
+        return stored
+    try:
+        fresh = os.path.getmtime(stored) >= os.path.getmtime(source)
+    except OSError:
+        fresh = False
+    if not fresh:
+        os.makedirs(store_dir, exist_ok=True)
+        _retire_input(store_dir, stored)
+        tmp = "{}.{}.tmp".format(stored, os.getpid())
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copy2(source, tmp)
+        os.replace(tmp, stored)
+    _stored_inputs.add(stored)
+    return stored
+
+
+def _retired_input(store_dir, inode):
+    return os.path.join(store_dir, ".retired", str(inode))
+
+
+def _retire_input(store_dir, stored):
+    """Keep a link to the previous version of a stored input under its inode, so
+    the pixel links made to it are told apart from other files."""
+    try:
+        inode = os.stat(stored).st_ino
+    except OSError:
+        return
+    os.makedirs(os.path.join(store_dir, ".retired"), exist_ok=True)
+    try:
+        os.link(stored, _retired_input(store_dir, inode))
+    except FileExistsError:
+        pass
+
+
+def _link_input(source, target, config, context):
+    store_dir = None
+    if config.get("inputLinks", "symlink") == "hardlink":
+        store_dir = os.path.join(context["workDir"], ".inputs")
+        link, source = os.link, _store_input(store_dir, source)
+    else:
+        link, source = os.symlink, os.path.abspath(source)
+    try:
+        link(source, target)
+    except FileExistsError:
+        if not _stale_link(source, target, store_dir):
+            return
+        # The source changed since the pixel was set up, the new link replaces
+        #  the old one at once.
+        inode = os.lstat(target).st_ino
+        tmp = "{}.{}.tmp".format(target, os.getpid())
+        link(source, tmp)
+        os.replace(tmp, target)
+        if store_dir is not None:
+            # The retired version goes once no pixel links to it anymore.
+            retired = _retired_input(store_dir, inode)
+            try:
+                if os.stat(retired).st_nlink == 1:
+                    os.remove(retired)
+            except OSError:
+                pass
+
+
+def _stale_link(source, target, store_dir):
+    """Whether target was linked by an earlier setup to another version of
+    source. Other files, like the ones written by plugins in
+    post_build_context, are kept."""
+    try:
+        if store_dir is None:
+            return os.path.islink(target) and os.readlink(target) != source
+        target_stat = os.lstat(target)
+        if os.path.samestat(os.stat(source), target_stat):
+            return False
+        return os.path.exists(_retired_input(store_dir, target_stat.st_ino))
+    except OSError:
+        return False
 
 
 def symlink_wth_soil(output_dir, config, context):
     if "include" in context:
         for include in context["include"]:
-            if os.path.exists(include):
+            if _input_exists(include):
                 include_file = os.path.join(output_dir, os.path.basename(include))
-                if not os.path.exists(include_file):
-                    os.symlink(os.path.abspath(include), include_file)
+                _link_input(include, include_file, config, context)
     if "weatherDir" in config:
         weather_file = os.path.join(output_dir, "{}.WTH".format(context["wsta"]))
-        if not os.path.exists(weather_file):
-            os.symlink(
-                os.path.abspath(os.path.join(config["weatherDir"], context["wthFile"])),
-                os.path.join(weather_file),
-            )
+        _link_input(
+            os.path.join(config["weatherDir"], context["wthFile"]),
+            weather_file,
+            config,
+            context,
+        )
     for soil in context["soilFiles"]:
         soil_file = os.path.join(output_dir, os.path.basename(soil))
-        if not os.path.exists(soil_file):
-            os.symlink(
-                os.path.abspath(soil), os.path.join(output_dir, os.path.basename(soil))
-            )
+        _link_input(soil, soil_file, config, context)
 
 
 def compose_peerless(context, config, env):
@@ -81,7 +282,34 @@ def compose_peerless(context, config, env):
     return context["contextWorkDir"]
 
 
-def process_context(context, plugins, config, env):
+def _unchanged(context, config, env, manifest):
+    """Hash the context and check it against the manifest, a pixel is only
+    considered unchanged in incremental mode and when its X file is present."""
+    digest = pythia.manifest.context_hash(
+        context, pythia.template.template_digest(env, context["template"])
+    )
+    unchanged = (
+        config.get("incremental", False)
+        and manifest.previous_hash(os.path.abspath(context["contextWorkDir"])) == digest
+        and os.path.exists(os.path.join(context["contextWorkDir"], context["template"]))
+    )
+    return digest, unchanged
+
+
+def _manifest_attributes(context, config):
+    """The sampled values saved in the manifest for the analytics."""
+    attributes = {}
+    for k in config.get("manifestAttributes", ["harvestArea", "population"]):
+        try:
+            v = float(context.get(k))
+        except (TypeError, ValueError):
+            continue
+        if math.isfinite(v):
+            attributes[k] = v
+    return attributes
+
+
+def process_context(context, plugins, config, env, manifest=None):
     if context is not None:
         pythia.io.make_run_directory(context["contextWorkDir"])
         # Post context hook
@@ -91,7 +319,15 @@ def process_context(context, plugins, config, env):
             plugins,
             context=context,
         ).get("context", context)
-        compose_peerless_result = compose_peerless(context, config, env)
+        unchanged = False
+        if manifest is not None:
+            digest, unchanged = _unchanged(context, config, env, manifest)
+        if unchanged:
+            if not config["silence"]:
+                print(".", end="", flush=True)
+            compose_peerless_result = context["contextWorkDir"]
+        else:
+            compose_peerless_result = compose_peerless(context, config, env)
         compose_peerless_result = pythia.plugin.run_plugin_functions(
             pythia.plugin.PluginHook.post_compose_peerless_pixel_success,
             plugins,
@@ -100,6 +336,16 @@ def process_context(context, plugins, config, env):
             config=config,
             env=env,
         ).get("compose_peerless_result", compose_peerless_result)
+        if manifest is not None:
+            manifest.record(
+                os.path.abspath(context["contextWorkDir"]),
+                context.get("name", ""),
+                context["template"],
+                digest,
+                float(context["lat"]),
+                float(context["lng"]),
+                _manifest_attributes(context, config),
+            )
         return os.path.abspath(compose_peerless_result)
     else:
         pythia.plugin.run_plugin_functions(
@@ -113,33 +359,84 @@ def process_context(context, plugins, config, env):
             print("X", end="", flush=True)
 
 
-def execute(config, plugins):
+def prepare_setup(config, plugins):
+    """Sample the pixels of every run and evaluate what can be evaluated once
+    for the whole setup. Returns the peers and compiled functions of each run,
+    the template environment and the manifest of this setup."""
     runs = config.get("runs", [])
-    if len(runs) == 0:
-        return
-    runlist = []
     for run in runs:
         pythia.io.make_run_directory(os.path.join(config["workDir"], run["name"]))
 
-    peers = [pythia.io.peer(r, config.get("sample", None)) for r in runs]
-    pool_size = config.get("threads", mp.cpu_count())
-    print("RUNNING WITH POOL SIZE: {}".format(pool_size))
-    env = pythia.template.init_engine(config["templateDir"])
+    peers = [pythia.io.peer(r, config.get("sample", None), config) for r in runs]
+    pythia.io.clear_sample_cache()
+    compiled = [pythia.compiler.compile_run(r) for r in runs]
+    env = pythia.template.init_engine(
+        config["templateDir"], pythia.template.bytecode_cache_dir(config)
+    )
     pythia.functions.build_ghr_cache(config)
+    manifest = pythia.manifest.Manifest(pythia.manifest.manifest_path(config))
+    manifest.begin()
+    if "soilCacheSize" in config:
+        pythia.soil_handler.setSoilCacheSize(config["soilCacheSize"])
 
-    # Parallelize the context build (build_context), it is CPU intensive because it
-    #  runs the functions (functions.py) declared in the config files.
-    with concurrent.futures.ProcessPoolExecutor(max_workers=pool_size) as executor:
-        tasks = _generate_context_args(runs, peers, config, plugins)
-        future_to_context = {executor.submit(build_context, *task): task for task in tasks}
-
-        # process_context is mostly I/O intensive, no reason to parallelize it.
-        for future in concurrent.futures.as_completed(future_to_context):
-            context_result = future.result()
-            if context_result is not None:
-                processed_result = process_context(context_result, plugins, config, env)
-                if processed_result is not None:
-                    runlist.append(processed_result)
+    # Evaluate the functions with a batch form over the whole run, only the
+    # remaining ones are evaluated per pixel in build_context.
+    if config.get("batchFunctions", True):
+        for idx, run in enumerate(runs):
+            batched, compiled[idx] = pythia.compiler.split_batch(compiled[idx])
+            peers[idx], skipped = pythia.compiler.evaluate_batch(
+                batched, run, peers[idx], config
+            )
+            _skip_batch_pixels(run, skipped, config, plugins)
+    return peers, compiled, env, manifest
+
+
+def collect_chunk(result, config, plugins, env, manifest, cache_stats):
+    """Process the result of a _build_context_chunk task and return the run
+    directories written. Unless parallelCompose is set, process_context runs
+    here on the contexts sent back by the workers. The soil cache counters of
+    the chunk are added to cache_stats."""
+    runlist = []
+    result, chunk_stats = result
+    for k, (hits, misses) in chunk_stats.items():
+        total = cache_stats.setdefault(k, [0, 0])
+        total[0] += hits
+        total[1] += misses
+    if config.get("parallelCompose", False):
+        results, records = result
+        runlist.extend(r for r in results if r is not None)
+        manifest.flush(records)
+        return runlist
+    for context_result in result:
+        if context_result is not None:
+            processed_result = process_context(
+                context_result, plugins, config, env, manifest
+            )
+            if processed_result is not None:
+                runlist.append(processed_result)
+    manifest.flush()
+    return runlist
+
+
+def _log_soil_cache(cache_stats):
+    # The batch evaluation runs in this process, its counters are added too.
+    for k, info in pythia.soil_handler.soilCacheInfo().items():
+        total = cache_stats.setdefault(k, [0, 0])
+        total[0] += info.hits
+        total[1] += info.misses
+    for k, (hits, misses) in sorted(cache_stats.items()):
+        logging.info("[PEERLESS] Soil %s cache: %d hits, %d misses", k, hits, misses)
+
+
+def finish_setup(config, plugins, env, manifest, runlist, cache_stats):
+    _log_soil_cache(cache_stats)
+    # The pixels of these runs not written by this setup dropped out of the
+    #  configuration, their directories are only removed in incremental mode.
+    manifest.drop_stale(
+        remove=config.get("incremental", False),
+        runs=[run.get("name", "") for run in config.get("runs", [])],
+    )
+    manifest.close()
 
     if config["exportRunlist"]:
         with open(os.path.join(config["workDir"], "run_list.txt"), "w") as f:
@@ -152,3 +449,39 @@ def execute(config, plugins):
         config=config,
         env=env,
     )
+
+
+def execute(config, plugins):
+    runs = config.get("runs", [])
+    if len(runs) == 0:
+        return
+    runlist = []
+    cache_stats = {}
+    peers, compiled, env, manifest = prepare_setup(config, plugins)
+    pool_size = config.get("threads", mp.cpu_count())
+    print("RUNNING WITH POOL SIZE: {}".format(pool_size))
+
+    # Parallelize the context build (build_context), it is CPU intensive because it
+    #  runs the functions (functions.py) declared in the config files.
+    #  The config, plugins and peers are sent once to every worker, the tasks are
+    #  chunks of pixel indexes.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=pool_size,
+        initializer=_init_worker,
+        initargs=(config, plugins, runs, peers, compiled, manifest.path),
+    ) as executor:
+        tasks = _generate_chunks(peers, config.get("chunkSize", 64))
+        max_in_flight = max(1, config.get("maxInFlight", pool_size * 4))
+
+        # New chunks are only submitted as the previous ones complete so the
+        #  pending futures and their results do not grow with the pixel count.
+        for future in _bounded_submit(
+            executor, _build_context_chunk, tasks, max_in_flight
+        ):
+            runlist.extend(
+                collect_chunk(
+                    future.result(), config, plugins, env, manifest, cache_stats
+                )
+            )
+
+    finish_setup(config, plugins, env, manifest, runlist, cache_stats)
@@ -0,0 +1,164 @@
+import concurrent.futures
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+
+import pythia.analytics
+import pythia.dssat
+import pythia.peerless
+import pythia.plugin
+
+
+def _run_simulation(details):
+    worker = pythia.peerless._worker
+    return pythia.dssat._run_dssat_safely(
+        details, worker["config"], worker["plugins"]
+    )
+
+
+def _simulations(config, run_dir):
+    return pythia.dssat._run_files(config, run_dir, sorted(os.listdir(run_dir)))
+
+
+def _harvest(config, run, run_dir, keep, manifest):
+    """Copy the kept outputs of a scratch pixel directory to the same pixel
+    directory under workDir and remove the scratch directory. The manifest then
+    records the pixel under workDir, where its outputs are."""
+    target = os.path.join(
+        pythia.analytics.get_run_basedir(config, run), *run_dir.split(os.path.sep)[-2:]
+    )
+    for name in keep:
+        source = os.path.join(run_dir, name)
+        if os.path.exists(source):
+            os.makedirs(target, exist_ok=True)
+            shutil.copyfile(source, os.path.join(target, name))
+    shutil.rmtree(run_dir, ignore_errors=True)
+    manifest.move(run_dir, os.path.abspath(target))
+
+
+def execute(config, plugins):
+    """Run the setup, DSSAT and the result collection as a single pipeline.
+    Each pixel directory is queued to DSSAT as soon as it is set up and each
+    finished simulation is collected right away. The setup and the
+    simulations share the same pool of workers."""
+    runs = config.get("runs", [])
+    if len(runs) == 0:
+        return
+    # In ephemeral mode the pixels are set up and run in a scratch directory,
+    #  which is removed once their outputs are harvested.
+    scratch = None
+    setup_config = config
+    if config.get("scratchDir", None):
+        os.makedirs(config["scratchDir"], exist_ok=True)
+        scratch = tempfile.mkdtemp(prefix="pythia-", dir=config["scratchDir"])
+        setup_config = {
+            **config,
+            "runs": [
+                {**run, "workDir": os.path.join(scratch, run["name"])} for run in runs
+            ],
+        }
+    keep = list(config.get("keepOutputs", []))
+    peers, compiled, env, manifest = pythia.peerless.prepare_setup(
+        setup_config, plugins
+    )
+    pool_size = config.get("cores", mp.cpu_count())
+    print("RUNNING WITH POOL SIZE: {}".format(pool_size))
+    collators = None
+    if config.get("analytics_setup", None):
+        collators = [pythia.analytics.RunCollator(config, run) for run in runs]
+    elif "summary.csv" not in keep:
+        keep.append("summary.csv")
+    display = pythia.dssat.display_async
+    if config["silence"]:
+        display = pythia.dssat.silent_async
+
+    runlist = []
+    simulations = []
+    cache_stats = {}
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=pool_size,
+        initializer=pythia.peerless._init_worker,
+        initargs=(
+            setup_config,
+            plugins,
+            setup_config["runs"],
+            peers,
+            compiled,
+            manifest.path,
+        ),
+    ) as executor:
+        chunk_size = config.get("chunkSize", 64)
+        chunks = pythia.peerless._generate_chunks(peers, chunk_size)
+        max_in_flight = max(1, config.get("maxInFlight", pool_size * 4))
+        setup = {}
+        running = {}
+        remaining = {}
+        pending = set()
+        while True:
+            # A chunk in setup weighs as many pixels as it holds. New chunks are
+            #  only set up while the pixels being set up or waiting for their
+            #  simulations fit in maxInFlight chunks.
+            while (len(setup) + 1) * chunk_size + len(remaining) <= (
+                max_in_flight * chunk_size
+            ):
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                future = executor.submit(pythia.peerless._build_context_chunk, *chunk)
+                setup[future] = chunk[0]
+                pending.add(future)
+            if not pending:
+                break
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                if future in setup:
+                    run_idx = setup.pop(future)
+                    run_dirs = pythia.peerless.collect_chunk(
+                        future.result(),
+                        setup_config,
+                        plugins,
+                        env,
+                        manifest,
+                        cache_stats,
+                    )
+                    runlist.extend(run_dirs)
+                    for run_dir in run_dirs:
+                        details_list = _simulations(config, run_dir)
+                        if details_list:
+                            remaining[run_dir] = len(details_list)
+                        elif scratch is not None:
+                            _harvest(config, runs[run_idx], run_dir, keep, manifest)
+                        for details in details_list:
+                            simulation = executor.submit(_run_simulation, details)
+                            running[simulation] = (run_idx, run_dir)
+                            pending.add(simulation)
+                            simulations.append(details)
+                else:
+                    run_idx, run_dir = running.pop(future)
+                    result = future.result()
+                    display(result)
+                    # A directory is collected once all its simulations ran.
+                    remaining[run_dir] -= 1
+                    if remaining[run_dir] == 0:
+                        del remaining[run_dir]
+                        if collators is not None:
+                            collators[run_idx].add(result[0])
+                        if scratch is not None:
+                            _harvest(config, runs[run_idx], run_dir, keep, manifest)
+
+    pythia.peerless.finish_setup(
+        setup_config, plugins, env, manifest, runlist, cache_stats
+    )
+    if scratch is not None:
+        shutil.rmtree(scratch, ignore_errors=True)
+    pythia.plugin.run_plugin_functions(
+        pythia.plugin.PluginHook.post_run_all,
+        plugins,
+        config=config,
+        run_list=simulations,
+    )
+    if collators is not None:
+        pythia.analytics.finish_outputs(config, [c.close() for c in collators])
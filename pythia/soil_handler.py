@@ -1,13 +1,128 @@
-def findSoilProfile(profile, soilFiles):
-    profile = "*{}".format(profile)
+import functools
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+# Profile byte offsets of every soil file read by this process, see getSoilIndex.
+_soil_indexes = {}
+
+
+def buildSoilIndex(soilFile):
+    """Map every profile ID of a soil file to the (offset, length) in bytes of
+    its lines. A profile starts at its *ID line and ends at the next blank line."""
+    index = {}
+    offset = 0
+    current = None
+    start = 0
+    with open(soilFile, "rb") as f:
+        for line in f:
+            stripped = line.strip()
+            if current is not None and stripped == b"":
+                index.setdefault(current, (start, offset - start))
+                current = None
+            if stripped.startswith(b"*") and len(stripped) > 1:
+                if current is not None:
+                    index.setdefault(current, (start, offset - start))
+                current = stripped[1:].split()[0].decode()
+                start = offset
+            offset += len(line)
+    if current is not None:
+        index.setdefault(current, (start, offset - start))
+    return index
+
+
+def _loadSoilIndexSidecar(sidecar, mtime):
+    try:
+        with open(sidecar) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("mtime") != mtime:
+        return None
+    return {k: tuple(v) for k, v in data["profiles"].items()}
+
+
+def getSoilIndex(soilFile, persist=False):
+    """The profile index of a soil file, built once per process and rebuilt when
+    the file changes. When persist is True the index is also saved in a
+    <file>.idx sidecar, which is reused while the file mtime matches."""
+    key = os.path.abspath(soilFile)
+    mtime = os.path.getmtime(soilFile)
+    if key in _soil_indexes and _soil_indexes[key][0] == mtime:
+        return _soil_indexes[key][1]
+    sidecar = "{}.idx".format(soilFile)
+    index = _loadSoilIndexSidecar(sidecar, mtime)
+    if index is None:
+        index = buildSoilIndex(soilFile)
+        if persist:
+            try:
+                with open(sidecar, "w") as f:
+                    json.dump({"mtime": mtime, "profiles": index}, f)
+            except OSError:
+                logging.warning("Unable to write the soil index %s", sidecar)
+    _soil_indexes[key] = (mtime, index)
+    return index
+
+
+def findSoilProfile(profile, soilFiles, persist=False):
     for sf in soilFiles:
-        with open(sf) as f:
-            for line in f:
-                if line.startswith(profile):
-                    return sf
+        if profile in getSoilIndex(sf, persist):
+            return sf
     return None
 
 
+def readSoilProfileBlock(profile, soilFile, persist=False):
+    """The raw bytes of a profile, read with a single seek."""
+    entry = getSoilIndex(soilFile, persist).get(profile)
+    if entry is None:
+        return None
+    offset, length = entry
+    with open(soilFile, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def readSoilProfileLines(profile, soilFile, persist=False):
+    """The stripped lines of a profile."""
+    block = readSoilProfileBlock(profile, soilFile, persist)
+    if block is None:
+        return []
+    return [line.strip() for line in block.decode(errors="replace").splitlines()]
+
+
+# Profiles already extracted by this process, see extractSoilProfile.
+_extracted_profiles = {}
+
+
+def extractSoilProfile(profile, soilFile, extractDir, persist=False):
+    """Write a single profile of a soil file to a small soil file and return its
+    path. The file keeps the name of the source file, so DSSAT still finds the
+    profile, in a directory named after the hash of its content. Pixels sharing
+    a profile share the extracted file, which is only written once."""
+    key = (os.path.abspath(soilFile), os.path.getmtime(soilFile), profile)
+    if key in _extracted_profiles:
+        return _extracted_profiles[key]
+    block = readSoilProfileBlock(profile, soilFile, persist)
+    if block is None:
+        return None
+    content = b"*SOILS: " + os.path.basename(soilFile).encode() + b"\n\n"
+    content += block.rstrip() + b"\n\n"
+    digest = hashlib.sha1(content).hexdigest()
+    target_dir = os.path.join(extractDir, digest[:2], digest)
+    target = os.path.join(target_dir, os.path.basename(soilFile))
+    if not os.path.exists(target):
+        os.makedirs(target_dir, exist_ok=True)
+        tmp = "{}.{}.tmp".format(target, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, target)
+    _extracted_profiles[key] = target
+    return target
+
+
 def transpose(listOfLists):
     return list(map(list, zip(*listOfLists)))
 
@@ -17,19 +132,8 @@ def formatSoilData(header, current_data):
     return {k: v for k, v in zip(header, transposed)}
 
 
-def readSoilLayers(profile, soilFile):
-    profile = "*{}".format(profile)
-    profilelines = []
-    found = False
-    with open(soilFile) as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith(profile):
-                found = True
-            if found and line == "":
-                found = False
-            if found:
-                profilelines.append(line)
+def readSoilLayers(profile, soilFile, persist=False):
+    profilelines = readSoilProfileLines(profile, soilFile, persist)
     in_data = False
     current_data = []
     header = []
@@ -159,3 +263,165 @@ def calculateICLayerData(soilData, run):
             [icnd * 0.9 for icnd in icndist],
         ]
     )
+
+
+# Matrix versions of the layer math above. They work on stacked profiles, one
+# row per pixel and one column per layer, and match the list versions exactly.
+# Profiles with fewer layers are padded, mask is False for the padding.
+
+
+def stackSoilLayers(soilDatas):
+    """Stack parsed profiles into SLB, SBDM, SLLL and SDUL matrices plus the
+    layer mask."""
+    width = max([len(d["SLB"]) for d in soilDatas], default=0)
+    stacked = {
+        "SLB": np.zeros((len(soilDatas), width), dtype=np.int64),
+        "SBDM": np.zeros((len(soilDatas), width)),
+        "SLLL": np.zeros((len(soilDatas), width)),
+        "SDUL": np.zeros((len(soilDatas), width)),
+        "mask": np.zeros((len(soilDatas), width), dtype=bool),
+    }
+    for row, soilData in enumerate(soilDatas):
+        n = len(soilData["SLB"])
+        stacked["SLB"][row, :n] = [int(v) for v in soilData["SLB"]]
+        for col in ["SBDM", "SLLL", "SDUL"]:
+            stacked[col][row, :n] = [float(v) for v in soilData[col]]
+        stacked["mask"][row, :n] = True
+    return stacked
+
+
+def _previousLayer(m):
+    prev = np.zeros_like(m)
+    prev[:, 1:] = m[:, :-1]
+    return prev
+
+
+def calculateSoilThicknessMatrix(slb):
+    return slb - _previousLayer(slb)
+
+
+def calculateSoilMidpointMatrix(slb):
+    prev = _previousLayer(slb)
+    first = np.zeros(slb.shape, dtype=bool)
+    first[:, :1] = True
+    mp = (np.minimum(100, slb) + np.maximum(40, prev)) / 2
+    return np.where((slb < 40) | first | (prev > 100), 0.0, mp)
+
+
+def calculateTopFracMatrix(slb, thickness):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        c = np.where(slb < 40, 1.0, 1 - ((slb - 40) / thickness))
+    return np.maximum(0.0, c)
+
+
+def calculateBotFracMatrix(slb, thickness):
+    prev = _previousLayer(slb)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        c = np.where(prev > 100, 1.0, (slb - 100) / thickness)
+    c[:, :1] = 0.0
+    return np.maximum(0.0, c)
+
+
+def calculateMidFracMatrix(tf, bf):
+    return 1 - bf - tf
+
+
+def calculateDepthFactorMatrix(mp, tf, mf):
+    return np.maximum(0.05, tf + (mf * (1 - (mp - 40) / 60)))
+
+
+def calculateWeightingFactorMatrix(slbdm, thickness, df):
+    return slbdm * thickness * df
+
+
+def calculateSoilLayerMassMatrix(slbdm, thickness, mask):
+    # Summed layer by layer, in the same order as the list version.
+    mass = np.zeros(slbdm.shape[0])
+    for col in range(slbdm.shape[1]):
+        mass = mass + np.where(
+            mask[:, col], slbdm[:, col] * thickness[:, col] * 100000, 0.0
+        )
+    return mass
+
+
+def calculateNConcentrationMatrix(n, mass):
+    return (n / mass) * 1000000
+
+
+def calculateICNTOTMatrix(wf, n, twf):
+    return wf * np.asarray(n)[:, None] / np.asarray(twf)[:, None]
+
+
+def calculateNDistMatrix(nconc, sbdm):
+    return np.broadcast_to(np.asarray(nconc, dtype=np.float64)[:, None], sbdm.shape)
+
+
+def calculateH2OMatrix(fractionalAW, slll, sdul):
+    fAW = np.asarray(fractionalAW)[..., None] / 100.0
+    return (fAW * (sdul - slll)) + slll
+
+
+def calculateICLayerDataMatrix(soilDatas, icin, icsw):
+    """calculateICLayerData for many profiles at once. icin and icsw% are
+    scalars or one value per profile."""
+    stacked = stackSoilLayers(soilDatas)
+    n = len(soilDatas)
+    icin = np.broadcast_to(np.asarray(icin), (n,))
+    icsw = np.broadcast_to(np.asarray(icsw), (n,))
+
+    thickness = calculateSoilThicknessMatrix(stacked["SLB"])
+    soil_mass = calculateSoilLayerMassMatrix(
+        stacked["SBDM"], thickness, stacked["mask"]
+    )
+    nconc = calculateNConcentrationMatrix(icin, soil_mass)
+    icndist = calculateNDistMatrix(nconc, stacked["SBDM"])
+    h2o = calculateH2OMatrix(icsw, stacked["SLLL"], stacked["SDUL"]).tolist()
+    snh4 = (icndist * 0.1).tolist()
+    sno3 = (icndist * 0.9).tolist()
+
+    return [
+        transpose(
+            [
+                soilData["SLB"],
+                h2o[row][: len(soilData["SLB"])],
+                snh4[row][: len(soilData["SLB"])],
+                sno3[row][: len(soilData["SLB"])],
+            ]
+        )
+        for row, soilData in enumerate(soilDatas)
+    ]
+
+
+def _cachedICLayerData(profile, soilFile, icin, icsw, persist):
+    layers = _cached_soil_layers(profile, soilFile, persist)
+    return calculateICLayerData(layers, {"icin": icin, "icsw%": icsw})
+
+
+_cached_soil_layers = functools.lru_cache(maxsize=1024)(readSoilLayers)
+_cached_ic_layers = functools.lru_cache(maxsize=1024)(_cachedICLayerData)
+
+
+def setSoilCacheSize(size):
+    """Resize (and clear) the parsed profile and IC layer caches."""
+    global _cached_soil_layers, _cached_ic_layers
+    _cached_soil_layers = functools.lru_cache(maxsize=size)(readSoilLayers)
+    _cached_ic_layers = functools.lru_cache(maxsize=size)(_cachedICLayerData)
+
+
+def cachedSoilLayers(profile, soilFile, persist=False):
+    """readSoilLayers memoized by profile. The result is shared, do not modify it."""
+    return _cached_soil_layers(profile, soilFile, persist)
+
+
+def cachedICLayerData(profile, soilFile, icin, icsw, persist=False):
+    """calculateICLayerData memoized by profile, icin and icsw%. The result is
+    shared, do not modify it."""
+    return _cached_ic_layers(profile, soilFile, icin, icsw, persist)
+
+
+def soilCacheInfo():
+    """Hit and miss counters of the profile and IC layer caches of this process."""
+    return {
+        "profiles": _cached_soil_layers.cache_info(),
+        "ic_layers": _cached_ic_layers.cache_info(),
+    }
@@ -1,5 +1,7 @@
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, meta
+import hashlib
 import logging
+import os
 import pythia.functions
 import pythia.util
 
@@ -41,35 +43,129 @@ _t_date_fields_4 = ["fodate"]
 _t_envmod_fields = ["eday", "erad", "emax", "emin", "erain", "eco2", "edew", "ewind"]
 
 
-def init_engine(template_dir):
-    return Environment(
-        loader=FileSystemLoader(template_dir), trim_blocks=True, lstrip_blocks=True
+def _compile_formatter(spec):
+    if "raw" in spec:
+        return spec["raw"].format
+    if "fmt" in spec:
+        return ("{" + spec["fmt"] + "}").format
+    fmt = "{" + spec.get("align", ":>") + spec.get("pad_with", "")
+    if "length" not in spec:
+        return (fmt + "}").format
+    fmt_float = (fmt + "{}.1f}}".format(spec["length"])).format
+    fmt_int = (fmt + "{}d}}".format(spec["length"])).format
+    fmt_other = (fmt + "{}}}".format(spec["length"])).format
+
+    def formatter(v):
+        if isinstance(v, float):
+            return fmt_float(v)
+        elif isinstance(v, int):
+            return fmt_int(v)
+        return fmt_other(v)
+
+    return formatter
+
+
+_t_formatters = {k: _compile_formatter(v) for k, v in _t_formats.items()}
+
+
+def bytecode_cache_dir(config):
+    return os.path.join(
+        config.get("templateCacheDir", config["workDir"]), ".jinja_cache"
+    )
+
+
+def init_engine(template_dir, cache_dir=None):
+    bytecode_cache = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    env = Environment(
+        loader=FileSystemLoader(template_dir),
+        trim_blocks=True,
+        lstrip_blocks=True,
+        bytecode_cache=bytecode_cache,
     )
+    env.pythia_templates = {}
+    return env
+
+
+def _walk_templates(env, template_file):
+    """Yield the name, source and syntax tree of a template and of every template
+    it includes, extends or imports. The name is None for a template only known
+    at render time."""
+    seen = set()
+    pending = [template_file]
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        if name is None:
+            yield None, None, None
+            continue
+        source = env.loader.get_source(env, name)[0]
+        ast = env.parse(source)
+        yield name, source, ast
+        pending.extend(meta.find_referenced_templates(ast))
+
+
+def template_variables(env, template_file):
+    """Return the top-level variables referenced by a template and the
+    templates it includes, extends or imports. Returns None when a
+    referenced template name is only known at render time."""
+    variables = set()
+    for name, _, ast in _walk_templates(env, template_file):
+        if name is None:
+            return None
+        variables |= meta.find_undeclared_variables(ast)
+    return variables
+
+
+def template_digest(env, template_file):
+    """A digest of the sources of a template and the templates it references,
+    computed once per environment."""
+    digests = getattr(env, "pythia_digests", None)
+    if digests is None:
+        digests = env.pythia_digests = {}
+    if template_file not in digests:
+        h = hashlib.sha1()
+        for name, source, _ in sorted(
+            _walk_templates(env, template_file), key=lambda t: t[0] or ""
+        ):
+            h.update("{}\0{}\0".format(name, source).encode())
+        digests[template_file] = h.hexdigest()
+    return digests[template_file]
+
+
+def default_block(keys):
+    """The formatted default values of the given keys, as auto_format_dict
+    sets them before formatting the context."""
+    clean = {}
+    for k in _t_formats:
+        if k in keys:
+            clean[k] = wrap_format(k, _t_formats[k].get("default", -99))
+    for k in _t_envmod_fields:
+        if k in keys:
+            clean[k] = envmod_format("A0")
+    return clean
+
+
+def _template_info(env, template_file):
+    templates = getattr(env, "pythia_templates", None)
+    if templates is None:
+        templates = env.pythia_templates = {}
+    if template_file not in templates:
+        keys = template_variables(env, template_file)
+        defaults = None if keys is None else default_block(keys)
+        templates[template_file] = (keys, defaults)
+    return templates[template_file]
 
 
 def wrap_format(k, v):
-    fmt = ""
-    if k in _t_formats:
-        if "raw" in _t_formats[k]:
-            fmt = _t_formats[k]["raw"]
-        elif "fmt" in _t_formats[k]:
-            fmt = "{" + _t_formats[k]["fmt"] + "}"
-        else:
-            fmt_align = _t_formats[k].get("align", ":>")
-            fmt_pad = _t_formats[k].get("pad_with", "")
-            if isinstance(v, float):
-                fmt_len = "{}.1f".format(_t_formats[k]["length"])
-            elif isinstance(v, int):
-                fmt_len = "{}d".format(_t_formats[k]["length"])
-            else:
-                if "length" in _t_formats[k]:
-                    fmt_len = "{}".format(_t_formats[k]["length"])
-                else:
-                    fmt_len = ""
-            fmt = "{" + fmt_align + fmt_pad + fmt_len + "}"
-    else:
-        fmt = "{}"
-    return fmt.format(v)
+    formatter = _t_formatters.get(k)
+    if formatter is None:
+        return "{}".format(v)
+    return formatter(v)
 
 
 def envmod_format(v):
@@ -89,19 +185,30 @@ def envmod_format(v):
     return "{}{:>4}".format(mod, val)
 
 
-def auto_format_dict(d):
+# The formatted defaults of every key, copied for each nested dictionary. Set
+# on first use, envmod_format needs pythia.functions which imports this module.
+_t_defaults = None
+
+
+def _all_defaults():
+    global _t_defaults
+    if _t_defaults is None:
+        _t_defaults = default_block(_t_formats.keys() | set(_t_envmod_fields))
+    return _t_defaults
+
+
+def auto_format_dict(d, keys=None, defaults=None):
+    """Format the values of d for a template. When keys is given only those
+    top-level keys are formatted, on top of the precomputed defaults."""
     if isinstance(d, str):
         return d
-    clean = {}
-    for k in _t_formats:
-        v = _t_formats[k]
-        if "default" in v:
-            clean[k] = wrap_format(k, v["default"])
-        else:
-            clean[k] = wrap_format(k, -99)
-    for k in _t_envmod_fields:
-        clean[k] = envmod_format("A0")
-    for k, v in d.items():
+    if keys is None:
+        clean = dict(_all_defaults())
+        items = d.items()
+    else:
+        clean = dict(defaults)
+        items = ((k, d[k]) for k in keys if k in d)
+    for k, v in items:
         if v == "-99" or v == -99:
             clean[k] = wrap_format(k, v)
         else:
@@ -128,5 +235,6 @@ def auto_format_dict(d):
 def render_template(env, template_file, context, auto_format=True):
     template = env.get_template(template_file)
     if auto_format:
-        context = auto_format_dict(context)
+        keys, defaults = _template_info(env, template_file)
+        context = auto_format_dict(context, keys, defaults)
     return template.render(context)
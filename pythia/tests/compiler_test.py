@@ -0,0 +1,192 @@
+import numpy as np
+
+import pythia.compiler
+import pythia.functions
+
+RUN = {
+    "name": "maize",
+    "startYear": 1984,
+    "sites": [[29.5, -82.5]],
+    "cultivar": "lookup_hc27::raster::cultivar.tif",
+    "static_cultivar": "lookup_hc27::42",
+    "planting": "auto_planting_window_doy::raster::planting.tif::10::30",
+    "fen_tot": 100.0,
+    "fertilizers": "split_fert_dap_percent::$fen_tot::2::0::40::30::60",
+    "season": "assign_by_raster_value::raster::season.tif::1::wet::2::dry::1::other",
+    "hdate": "date_offset::$pdate::120",
+    "sdate": "date_from_doy_raster::raster::sdate.tif",
+}
+
+CONTEXT = {
+    **RUN,
+    "lat": 29.5,
+    "lng": -82.5,
+    "cultivar": np.int16(7),
+    "planting": np.int16(100),
+    "season": np.uint8(2),
+    "sdate": np.int16(45),
+}
+
+
+def _evaluate(functions, run, context, config={}):
+    for fn in functions:
+        res = fn(run, context, config)
+        if res is None:
+            return None
+        context = {**context, **res}
+    return context
+
+
+def test_compiled_matches_uncompiled():
+    compiled = pythia.compiler.compile_run(RUN)
+    assert [f.key for f in compiled] == [
+        "cultivar",
+        "static_cultivar",
+        "planting",
+        "fertilizers",
+        "season",
+        "hdate",
+        "sdate",
+    ]
+    context = _evaluate(compiled, RUN, CONTEXT)
+    expected = dict(CONTEXT)
+    for f in compiled:
+        expected = {**expected, **f.fn(f.key, RUN, expected, {})}
+    assert context == expected
+    assert context["static_cultivar"] == "HC_GEN0042"
+    assert context["season"] == "dry"
+    assert context["hdate"] == "1984-08-17"
+    assert context["fertilizers"] == [
+        {"fdap": 0, "famn": 40.0},
+        {"fdap": 30, "famn": 60.0},
+    ]
+
+
+def test_invalid_spec_skips_pixel():
+    run = {**RUN, "fertilizers": "split_fert_dap_percent::$fen_tot::2::0::40::30::50"}
+    compiled = pythia.compiler.compile_run(run)
+    assert (
+        _evaluate(compiled, run, {**CONTEXT, "fertilizers": run["fertilizers"]}) is None
+    )
+
+
+def test_functions_are_ordered_by_references():
+    run = {
+        "hdate": "date_offset::$pdate::120",
+        "ic_layers": "generate_ic_layers::$id_soil",
+        "wsta": "lookup_wth::SSUD::vector::cells.shp::CellID",
+        "id_soil": "lookup_ghr::raster::ghr.tif",
+        "planting": "auto_planting_window_doy::raster::planting.tif::10::30",
+        "cultivar": "lookup_hc27::raster::cultivar.tif",
+    }
+    compiled = pythia.compiler.compile_run(run)
+    assert [f.key for f in compiled] == [
+        "id_soil",
+        "planting",
+        "hdate",
+        "cultivar",
+        "wsta",
+        "ic_layers",
+    ]
+
+
+def test_circular_references_keep_configuration_order():
+    run = {
+        "a": "date_offset::$b::1",
+        "b": "date_offset::$a::1",
+        "c": "lookup_hc27::1",
+    }
+    compiled = pythia.compiler.compile_run(run)
+    assert [f.key for f in compiled] == ["c", "a", "b"]
+
+
+def test_batch_matches_per_pixel(tmp_path):
+    from pythia.io import PeerResult
+    from pythia.tests.io_test import _write_points
+
+    shp = _write_points(tmp_path / "cells.shp", [(101, (0.0, 0.0)), (102, (5.0, 5.0))])
+    run = {
+        "name": "maize",
+        "startYear": 1984,
+        "cultivar": "lookup_hc27::raster::cultivar.tif",
+        "planting": "auto_planting_window_doy::raster::planting.tif::10::30",
+        "season": "assign_by_raster_value::raster::season.tif::1::wet::2::dry",
+        "sdate": "date_from_doy_raster::raster::sdate.tif",
+        "hdate": "date_offset::$pdate::120",
+        "wsta": "lookup_wth::SSUD::vector::{}::CellID".format(shp),
+    }
+    layers = ["cultivar", "planting", "season", "sdate"]
+    values = np.zeros(
+        5,
+        dtype=[
+            ("cultivar", "i2"),
+            ("planting", "i2"),
+            ("season", "u1"),
+            ("sdate", "i2"),
+        ],
+    )
+    values["cultivar"] = [7, 8, 7, 7, 9]
+    values["planting"] = [100, 100, 120, 100, 90]
+    values["season"] = [1, 2, 3, 1, 2]
+    values["sdate"] = [45, 400, 45, 46, 45]
+    mask = np.zeros(5, dtype=[(layer, bool) for layer in layers])
+    xs = np.array([0.1, 4.0, 1.0, 6.0, -1.0])
+    ys = np.array([0.1, 4.0, 1.0, 6.0, -1.0])
+    peers = PeerResult(xs, ys, layers, values, mask, np.arange(5))
+
+    compiled = pythia.compiler.compile_run(run)
+    batched, pixel = pythia.compiler.split_batch(compiled)
+    assert [f.key for f in pixel] == ["hdate"]
+    batch_peers, skipped = pythia.compiler.evaluate_batch(batched, run, peers, {})
+    assert list(skipped.index) == [1, 2]
+
+    expected = [_evaluate(compiled, run, {**run, **cell}) for cell in peers]
+    assert [e is None for e in expected] == [False, True, True, False, False]
+    contexts = [_evaluate(pixel, run, {**run, **cell}) for cell in batch_peers]
+    assert contexts == [e for e in expected if e is not None]
+    assert contexts[1]["wthFile"] == "102.WTH"
+
+
+def test_batch_ic_layers_match_per_pixel(tmp_path):
+    from pythia.cache_manager import cache
+    from pythia.io import PeerResult
+    from pythia.tests.soil_handler_test import SOIL_FILE
+
+    (tmp_path / "IB.SOL").write_text(SOIL_FILE)
+    cache["ghr_profiles"] = {1: "IB00000001", 2: "IB00000002"}
+    config = {"ghr_root": str(tmp_path)}
+    run = {
+        "icin": 5,
+        "icsw%": 25,
+        "ic_layers": "generate_ic_layers::$id_soil",
+        "id_soil": "lookup_ghr::raster::ghr.tif",
+    }
+    values = np.zeros(4, dtype=[("id_soil", "i4")])
+    values["id_soil"] = [1, 2, 3, 1]
+    mask = np.zeros(4, dtype=[("id_soil", bool)])
+    xs = np.arange(4, dtype=float)
+    peers = PeerResult(xs, xs, ["id_soil"], values, mask, np.arange(4))
+    try:
+        compiled = pythia.compiler.compile_run(run)
+        batched, pixel = pythia.compiler.split_batch(compiled)
+        assert pixel == []
+        batch_peers, skipped = pythia.compiler.evaluate_batch(
+            batched, run, peers, config
+        )
+        expected = [_evaluate(compiled, run, {**run, **cell}, config) for cell in peers]
+        assert list(skipped.index) == [2]
+        assert [{**run, **cell} for cell in batch_peers] == [
+            e for e in expected if e is not None
+        ]
+    finally:
+        del cache["ghr_profiles"]
+
+
+def test_functions_providing_the_same_key_keep_configuration_order():
+    run = {
+        "sdate": "1984-01-01",
+        "planting": "auto_planting_window_doy_shape::vector::cells.shp::DOY::0::30",
+        "pdate": "date_offset::$sdate::10",
+    }
+    compiled = pythia.compiler.compile_run(run)
+    assert [f.key for f in compiled] == ["planting", "pdate"]
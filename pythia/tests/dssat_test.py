@@ -0,0 +1,11 @@
+import pythia.dssat
+
+
+def test_failing_run_is_reported(tmp_path):
+    details = {"dir": str(tmp_path), "file": "TEST.SNX"}
+    # Without an executable _run_dssat raises a KeyError
+    pythia.dssat._init_worker({"dssat": {}}, {})
+    loc, xfile, out, err, retcode = pythia.dssat._run_dssat_task(details)
+    assert (loc, xfile, retcode) == (str(tmp_path), "TEST.SNX", -1)
+    assert len(out.decode().split("\n")) - 1 == 1
+    pythia.dssat.silent_async((loc, xfile, out, err, retcode))
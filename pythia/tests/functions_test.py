@@ -0,0 +1,68 @@
+import os
+import sqlite3
+
+import pythia.functions
+from pythia.cache_manager import cache
+
+
+def _ghr_db(path, rows):
+    os.makedirs(path, exist_ok=True)
+    with sqlite3.connect(os.path.join(path, "GHR.db")) as conn:
+        conn.execute("CREATE TABLE profile_map (id INTEGER, profile TEXT)")
+        conn.executemany("INSERT INTO profile_map VALUES (?, ?)", rows)
+
+
+def test_ghr_profiles_dense_and_sparse(tmp_path):
+    dense = pythia.functions.GHRProfiles.from_dict({1: "IB00000001", 3: "IB00000003"})
+    sparse = pythia.functions.GHRProfiles.from_dict({5: "IB00000005", 10**9: "XX"})
+    assert dense.keys is None
+    assert sparse.keys is not None
+    for profiles in [dense, sparse]:
+        profiles.save(str(tmp_path))
+        loaded = pythia.functions.GHRProfiles.load(str(tmp_path))
+        for ghr in [profiles, loaded]:
+            assert 2 not in ghr
+            assert -1 not in ghr
+            assert 10**10 not in ghr
+    assert dense[3] == "IB00000003"
+    assert sparse[10**9] == "XX"
+
+
+def test_build_ghr_cache(tmp_path):
+    ghr_root = str(tmp_path / "ghr")
+    _ghr_db(ghr_root, [(1, "IB00000001"), (2, ""), (4, "IB00000004")])
+    config = {"ghr_root": ghr_root, "workDir": str(tmp_path / "work")}
+    try:
+        pythia.functions.build_ghr_cache(config)
+        assert os.path.exists(tmp_path / "work" / ".ghr_cache" / "ghr_profiles.npy")
+        cache.pop("ghr_profiles")
+        pythia.functions.build_ghr_cache(config)
+        ghr = cache["ghr_profiles"]
+        assert 1 in ghr and 2 not in ghr and 4 in ghr
+        context = {"id_soil": 4.0, "lat": 1.0, "lng": 2.0}
+        run = {"id_soil": "lookup_ghr::raster::ghr.tif"}
+        assert pythia.functions.lookup_ghr("id_soil", run, context, config) == {
+            "id_soil": "IB00000004",
+            "soilFiles": [os.path.join(ghr_root, "IB.SOL")],
+        }
+        context["id_soil"] = 2
+        assert pythia.functions.lookup_ghr("id_soil", run, context, config) is None
+    finally:
+        cache.pop("ghr_profiles", None)
+
+
+def test_build_ghr_cache_follows_the_database(tmp_path):
+    first = str(tmp_path / "first")
+    second = str(tmp_path / "second")
+    _ghr_db(second, [(1, "IB00000002")])
+    _ghr_db(first, [(1, "IB00000001")])
+    # The second database is older than the cache built from the first one
+    os.utime(os.path.join(second, "GHR.db"), (0, 0))
+    config = {"ghr_root": first, "workDir": str(tmp_path / "work")}
+    try:
+        pythia.functions.build_ghr_cache(config)
+        assert cache["ghr_profiles"][1] == "IB00000001"
+        pythia.functions.build_ghr_cache({**config, "ghr_root": second})
+        assert cache["ghr_profiles"][1] == "IB00000002"
+    finally:
+        cache.pop("ghr_profiles", None)
@@ -0,0 +1,178 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import pythia.io
+
+
+def _write_raster(path, data, nodata=-1):
+    profile = {
+        "driver": "GTiff",
+        "height": data.shape[0],
+        "width": data.shape[1],
+        "count": 1,
+        "dtype": data.dtype,
+        "crs": "EPSG:4326",
+        "transform": from_origin(-10.0, 10.0, 0.5, 0.5),
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 16,
+        "blockysize": 16,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+    return str(path)
+
+
+def _sites():
+    return [(-9.9, 9.9), (-0.1, 0.1), (9.8, -9.8), (3.3, 4.4), (20.0, 20.0)]
+
+
+def test_read_sites_matches_get_site_raster_value(tmp_path):
+    data = np.arange(40 * 40, dtype="int16").reshape(40, 40)
+    data[10, 20] = -1
+    raster = _write_raster(tmp_path / "layer.tif", data)
+    sites = _sites() + [(0.1, 4.9)]
+    xs, ys = pythia.io.site_arrays(sites)
+    with rasterio.open(raster) as ds:
+        band = ds.read(1, masked=True)
+        expected = [pythia.io.get_site_raster_value(ds, band, s) for s in sites]
+        rows, cols = pythia.io.index_sites(ds, xs, ys)
+        assert [ds.index(*s) for s in sites] == list(zip(rows, cols))
+        for windowed in [False, True]:
+            values, mask = pythia.io.read_sites(ds, rows, cols, windowed)
+            for idx, value in enumerate(expected):
+                if value is None:
+                    assert mask[idx]
+                else:
+                    assert not mask[idx] and values[idx] == value
+
+
+def test_peer_windowed_matches_default(tmp_path):
+    data = np.arange(40 * 40, dtype="int16").reshape(40, 40)
+    harvest = np.ones((40, 40), dtype="int16")
+    harvest[0, 0] = 0
+    run = {
+        "sites": [[lat, lng] for lng, lat in _sites()[:-1]],
+        "layer": "lookup_hc27::raster::{}".format(
+            _write_raster(tmp_path / "layer.tif", data)
+        ),
+        "harvestArea": "raster::{}".format(
+            _write_raster(tmp_path / "harea.tif", harvest)
+        ),
+    }
+    default = pythia.io.peer(run)
+    windowed = pythia.io.peer(run, config={"windowedSampling": True})
+    assert len(default) == 3
+    assert list(windowed) == list(default)
+    assert len(default[:2]) == 2
+    assert default[0] == {
+        "lat": 0.1,
+        "lng": -0.1,
+        "xcrd": -0.1,
+        "ycrd": 0.1,
+        "layer": 19 * 40 + 19,
+        "harvestArea": 1,
+    }
+
+
+def test_peer_mask_layers(tmp_path):
+    data = np.arange(40 * 40, dtype="int16").reshape(40, 40)
+    cropland = np.ones((40, 40), dtype="uint8")
+    cropland[19, 19] = 0
+    run = {
+        "sites": [[lat, lng] for lng, lat in _sites()],
+        "layer": "raster::{}".format(_write_raster(tmp_path / "layer.tif", data)),
+        "cropland": "raster::{}".format(
+            _write_raster(tmp_path / "cropland.tif", cropland, nodata=255)
+        ),
+    }
+    assert len(pythia.io.peer(run)) == 4
+    peers = pythia.io.peer({**run, "maskLayers": ["cropland"]})
+    assert [(p["lng"], p["lat"]) for p in peers] == [
+        (-9.9, 9.9),
+        (9.8, -9.8),
+        (3.3, 4.4),
+    ]
+    assert peers.mask["layer"][1]
+
+
+def test_sample_raster_is_shared(tmp_path):
+    data = np.arange(40 * 40, dtype="int16").reshape(40, 40)
+    raster = _write_raster(tmp_path / "layer.tif", data)
+    xs, ys = pythia.io.site_arrays(_sites())
+    first = pythia.io.sample_raster(raster, xs, ys)
+    assert pythia.io.sample_raster(raster, xs.copy(), ys.copy()) is first
+    assert pythia.io.sample_raster(raster, xs[:2], ys[:2]) is not first
+    pythia.io.clear_sample_cache()
+    assert pythia.io.sample_raster(raster, xs, ys) is not first
+
+
+def _write_points(path, points):
+    import fiona
+
+    schema = {"geometry": "Point", "properties": {"CellID": "int"}}
+    with fiona.open(str(path), "w", "ESRI Shapefile", schema, crs="EPSG:4326") as dst:
+        for cell_id, (x, y) in points:
+            dst.write(
+                {
+                    "geometry": {"type": "Point", "coordinates": (x, y)},
+                    "properties": {"CellID": cell_id},
+                }
+            )
+    return str(path)
+
+
+def test_find_closest_vector_coords(tmp_path):
+    shp = _write_points(
+        tmp_path / "cells.shp",
+        [(10, (0.0, 0.0)), (11, (1.0, 1.0)), (12, (1.0, 1.0)), (13, (-2.0, 3.5))],
+    )
+    assert pythia.io.find_closest_vector_coords(shp, 0.2, 0.1, "CellID") == 10
+    assert pythia.io.find_closest_vector_coords(shp, 0.9, 1.2, "CellID") == 11
+    assert pythia.io.find_closest_vector_coords_batch(
+        shp, [0.2, 0.9, -5.0], [0.1, 1.2, 5.0], "CellID"
+    ) == [10, 11, 13]
+
+
+def test_vector_layer_lookups_and_sidecar(tmp_path):
+    shp = _write_points(
+        tmp_path / "sites.shp", [(7, (1.5, 2.5)), (8, (3.0, 4.0)), (9, (1.5, 2.5))]
+    )
+    assert pythia.io.extract_vector_coords(shp) == [(1.5, 2.5), (3.0, 4.0), (1.5, 2.5)]
+    assert pythia.io.find_vector_coords(shp, 1.5, 2.5, "CellID") == 7
+    assert pythia.io.find_vector_coords(shp, 3.0, 4.0, "CellID") == 8
+    assert pythia.io.find_vector_coords(shp, 3.0, 4.1, "CellID") is None
+
+    layer = pythia.io.VectorLayer.from_file(shp)
+    layer.save(tmp_path / "sites.npz")
+    loaded = pythia.io.VectorLayer.from_sidecar(tmp_path / "sites.npz")
+    assert loaded.sites() == layer.sites()
+    assert loaded.attribute("CellID", 1) == 8
+
+
+def test_nearest_batch_matches_nearest():
+    rng = np.random.RandomState(1)
+    xs, ys = np.meshgrid(np.arange(10.0), np.arange(10.0))
+    index = pythia.io.NearestIndex(xs.ravel(), ys.ravel(), np.arange(100) + 1000)
+    # Equidistant from four grid points, then far from every point
+    lngs = np.concatenate([rng.uniform(-1, 10, 200), np.arange(9) + 0.5, [50, -3]])
+    lats = np.concatenate([rng.uniform(-1, 10, 200), np.arange(9) + 0.5, [4, -80]])
+    expected = [index.nearest(x, y) for x, y in zip(lngs, lats)]
+    assert index.nearest_batch(lngs, lats) == expected
+    assert index.nearest_batch(lngs, lats, radii=(1,)) == expected
+    assert index.nearest_batch([], []) == []
+
+
+def test_nearest_batch_clustered_points():
+    rng = np.random.RandomState(2)
+    # Duplicated points and a dense cluster in a sparse extent
+    xs = np.concatenate([rng.normal(0, 0.01, 300), [5.0, 5.0, -7.5], [2.0] * 4])
+    ys = np.concatenate([rng.normal(0, 0.01, 300), [5.0, 5.0, 9.0], [-2.0] * 4])
+    index = pythia.io.NearestIndex(xs, ys, np.arange(len(xs)))
+    lngs = rng.uniform(-10, 10, 300)
+    lats = rng.uniform(-10, 10, 300)
+    expected = [index.nearest(x, y) for x, y in zip(lngs, lats)]
+    assert index.nearest_batch(lngs, lats) == expected
+    single = pythia.io.NearestIndex(np.array([1.0]), np.array([1.0]), ["a"])
+    assert single.nearest_batch([0.0, 3.0], [0.0, 1.0]) == ["a", "a"]
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+
+import pythia.manifest
+
+
+def test_context_hash():
+    context = {"lat": 1.5, "lng": 2.5, "ingeno": "IB0001", "sites": [[1.5, 2.5]]}
+    digest = pythia.manifest.context_hash(context, "template")
+    assert digest == pythia.manifest.context_hash({**context, "sites": []}, "template")
+    assert digest != pythia.manifest.context_hash(context, "other")
+    assert digest != pythia.manifest.context_hash({**context, "ingeno": "IB0002"})
+
+
+def test_manifest_generations(tmp_path):
+    dirs = [tmp_path / d for d in ["a", "b", "c"]]
+    for d in dirs:
+        d.mkdir()
+    manifest = pythia.manifest.Manifest(str(tmp_path / "manifest.db"))
+    assert manifest.begin() == 1
+    for d in dirs:
+        manifest.record(str(d), "maize", "TEST.SNX", d.name)
+    manifest.flush()
+    assert manifest.drop_stale(remove=True) == []
+    manifest.close()
+
+    manifest = pythia.manifest.Manifest(str(tmp_path / "manifest.db"))
+    assert manifest.begin() == 2
+    assert manifest.previous_hash(str(dirs[0])) == "a"
+    assert manifest.previous_hash(str(tmp_path / "d")) is None
+    manifest.record(str(dirs[0]), "maize", "TEST.SNX", "a2")
+    manifest.flush()
+    assert sorted(manifest.drop_stale(remove=True)) == [str(dirs[1]), str(dirs[2])]
+    assert [d.exists() for d in dirs] == [True, False, False]
+    assert [e["dir"] for e in manifest.entries()] == [str(dirs[0])]
+    assert manifest.previous_hash(str(dirs[0])) == "a2"
+
+
+def test_manifest_entries(tmp_path):
+    manifest = pythia.manifest.Manifest(str(tmp_path / "manifest.db"))
+    manifest.begin()
+    manifest.record(
+        "/w/maize/a", "maize", "TEST.SNX", "h", 1.5, -2.5, {"harvestArea": 2.0}
+    )
+    manifest.record("/w/sorghum/a", "sorghum", "TEST.SNX", "h")
+    manifest.flush()
+    assert list(manifest.entries("maize")) == [
+        {
+            "dir": "/w/maize/a",
+            "run": "maize",
+            "xfile": "TEST.SNX",
+            "lat": 1.5,
+            "lng": -2.5,
+            "attributes": {"harvestArea": 2.0},
+        }
+    ]
+    assert len(list(manifest.entries())) == 2
+
+
+def test_open_manifest(tmp_path):
+    config = {"workDir": str(tmp_path)}
+    assert pythia.manifest.open_manifest(config) is None
+    # A manifest written before the coordinates were recorded
+    with sqlite3.connect(pythia.manifest.manifest_path(config)) as conn:
+        conn.execute(
+            "CREATE TABLE pixels (dir TEXT PRIMARY KEY, run TEXT, xfile TEXT, "
+            "hash TEXT, generation INTEGER)"
+        )
+        conn.execute("INSERT INTO pixels VALUES ('/w/maize/a', 'maize', 'X', 'h', 1)")
+    manifest = pythia.manifest.open_manifest(config)
+    (entry,) = manifest.entries()
+    assert entry["lat"] is None and entry["attributes"] == {}
+    manifest.close()
+
+
+def test_manifest_move(tmp_path):
+    target = tmp_path / "a"
+    target.mkdir()
+    manifest = pythia.manifest.Manifest(str(tmp_path / "manifest.db"))
+    manifest.begin()
+    manifest.record(str(target), "maize", "TEST.SNX", "old")
+    manifest.flush()
+    manifest.close()
+
+    manifest = pythia.manifest.Manifest(str(tmp_path / "manifest.db"))
+    manifest.begin()
+    manifest.record("/scratch/a", "maize", "TEST.SNX", "new")
+    manifest.flush()
+    manifest.move("/scratch/a", str(target))
+    assert manifest.drop_stale(remove=True) == []
+    assert target.exists()
+    assert [e["dir"] for e in manifest.entries()] == [str(target)]
+    assert manifest.previous_hash(str(target)) == "new"
+
+
+def test_run_list_from_manifest(tmp_path):
+    import pythia.dssat
+
+    config = {"workDir": str(tmp_path), "dssat": {}}
+    pixel = tmp_path / "maize" / "a"
+    pixel.mkdir(parents=True)
+    for name in ["TEST.SNX", "PLUGIN.SNX", "SSUD.WTH"]:
+        (pixel / name).write_text("")
+    manifest = pythia.manifest.Manifest(pythia.manifest.manifest_path(config))
+    manifest.begin()
+    manifest.record(str(pixel), "maize", "TEST.SNX", "h")
+    manifest.flush()
+    manifest.close()
+    assert pythia.dssat._generate_run_list(config) == [
+        {"dir": str(pixel), "file": "TEST.SNX"}
+    ]
+    # The X files written by plugins are only found by walking workDir
+    config["dssat"]["walkWorkDir"] = True
+    assert sorted(r["file"] for r in pythia.dssat._generate_run_list(config)) == [
+        "PLUGIN.SNX",
+        "TEST.SNX",
+    ]
+
+
+def test_stale_pixels_of_other_runs_are_kept(tmp_path):
+    manifest = pythia.manifest.Manifest(str(tmp_path / "manifest.db"))
+    manifest.begin()
+    manifest.record("/w/maize/a", "maize", "TEST.SNX", "h")
+    manifest.record("/w/rice/a", "rice", "TEST.SNX", "h")
+    manifest.flush()
+    manifest.close()
+
+    manifest = pythia.manifest.Manifest(str(tmp_path / "manifest.db"))
+    manifest.begin()
+    manifest.record("/w/rice/b", "rice", "TEST.SNX", "h")
+    manifest.flush()
+    assert manifest.drop_stale(runs=["rice"]) == ["/w/rice/a"]
+    assert [e["dir"] for e in manifest.entries()] == ["/w/maize/a", "/w/rice/b"]
+
+
+def test_runs_missing_from_the_manifest_are_walked(tmp_path):
+    import pythia.analytics
+    import pythia.dssat
+
+    config = {
+        "workDir": str(tmp_path),
+        "dssat": {},
+        "runs": [{"name": "maize"}, {"name": "rice"}],
+    }
+    for run in ["maize", "rice"]:
+        pixel = tmp_path / run / "1_000N" / "2_000E"
+        pixel.mkdir(parents=True)
+        (pixel / "TEST.SNX").write_text("")
+        (pixel / "summary.csv").write_text("HARWT\n1\n")
+    manifest = pythia.manifest.Manifest(pythia.manifest.manifest_path(config))
+    manifest.begin()
+    rice = str(tmp_path / "rice" / "1_000N" / "2_000E")
+    manifest.record(rice, "rice", "TEST.SNX", "h", 1.0, 2.0)
+    manifest.flush()
+    manifest.close()
+    assert sorted(r["dir"] for r in pythia.dssat._generate_run_list(config)) == [
+        str(tmp_path / "maize" / "1_000N" / "2_000E"),
+        rice,
+    ]
+    with open(pythia.analytics.collate_outputs(config, {"name": "maize"})) as f:
+        assert len(f.readlines()) == 2
@@ -0,0 +1,142 @@
+import concurrent.futures
+
+import pythia.peerless
+import pythia.soil_handler
+
+
+def test_bounded_submit_limits_pending_tasks():
+    submitted = []
+
+    def tasks():
+        for i in range(50):
+            submitted.append(i)
+            yield (i,)
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        for future in pythia.peerless._bounded_submit(
+            executor, lambda x: x * 2, tasks(), 3
+        ):
+            results.append(future.result())
+            assert len(submitted) - len(results) <= 3
+    assert sorted(results) == [i * 2 for i in range(50)]
+
+
+def _inputs(tmp_path):
+    (tmp_path / "weather").mkdir()
+    (tmp_path / "weather" / "1.WTH").write_text("weather")
+    (tmp_path / "XX.SOL").write_text("soil")
+    (tmp_path / "inc.CUL").write_text("cul")
+    config = {"weatherDir": str(tmp_path / "weather")}
+    context = {
+        "workDir": str(tmp_path / "run"),
+        "include": [str(tmp_path / "inc.CUL"), str(tmp_path / "missing.CUL")],
+        "wsta": "SSUD",
+        "wthFile": "1.WTH",
+        "soilFiles": [str(tmp_path / "XX.SOL")],
+    }
+    return config, context
+
+
+def test_symlink_inputs(tmp_path):
+    config, context = _inputs(tmp_path)
+    out = tmp_path / "run" / "pixel"
+    out.mkdir(parents=True)
+    for _ in range(2):
+        pythia.peerless.symlink_wth_soil(str(out), config, context)
+    assert sorted(p.name for p in out.iterdir()) == ["SSUD.WTH", "XX.SOL", "inc.CUL"]
+    assert (out / "SSUD.WTH").is_symlink()
+    assert (out / "SSUD.WTH").read_text() == "weather"
+
+
+def test_hardlink_inputs(tmp_path):
+    config, context = _inputs(tmp_path)
+    config["inputLinks"] = "hardlink"
+    for pixel in ["a", "b"]:
+        out = tmp_path / "run" / pixel
+        out.mkdir(parents=True)
+        pythia.peerless.symlink_wth_soil(str(out), config, context)
+        assert not (out / "XX.SOL").is_symlink()
+        assert (out / "XX.SOL").read_text() == "soil"
+        assert (out / "SSUD.WTH").read_text() == "weather"
+    assert len(list((tmp_path / "run" / ".inputs").iterdir())) == 3
+    assert (tmp_path / "run" / "a" / "inc.CUL").stat().st_ino == (
+        tmp_path / "run" / "b" / "inc.CUL"
+    ).stat().st_ino
+
+
+def test_replaced_inputs_are_relinked(tmp_path):
+    import os
+
+    config, context = _inputs(tmp_path)
+    for links in ["symlink", "hardlink"]:
+        config["inputLinks"] = links
+        pixels = [tmp_path / "run" / links / p for p in ["a", "b"]]
+        for out in pixels:
+            out.mkdir(parents=True)
+            pythia.peerless.symlink_wth_soil(str(out), config, context)
+        new = tmp_path / "new.SOL"
+        new.write_text("new soil " + links)
+        os.utime(new, (os.stat(new).st_atime, os.stat(new).st_mtime + 10))
+        os.replace(new, tmp_path / "XX.SOL")
+        # A rerun starts from fresh process caches
+        pythia.peerless._stored_inputs.clear()
+        for out in pixels:
+            pythia.peerless.symlink_wth_soil(str(out), config, context)
+            assert (out / "XX.SOL").read_text() == "new soil " + links
+            assert (out / "XX.SOL").is_symlink() == (links == "symlink")
+            assert sorted(p.name for p in out.iterdir()) == [
+                "SSUD.WTH",
+                "XX.SOL",
+                "inc.CUL",
+            ]
+    # The old version of the soil file is gone once no pixel links to it
+    assert list((tmp_path / "run" / ".inputs" / ".retired").iterdir()) == []
+
+
+def test_plugin_written_inputs_are_kept(tmp_path):
+    config, context = _inputs(tmp_path)
+    for links in ["symlink", "hardlink"]:
+        config["inputLinks"] = links
+        out = tmp_path / "run" / links
+        out.mkdir(parents=True)
+        # Written by a post_build_context plugin, like weather_forecast_simple
+        (out / "SSUD.WTH").write_text("forecast")
+        for _ in range(2):
+            pythia.peerless.symlink_wth_soil(str(out), config, context)
+            assert not (out / "SSUD.WTH").is_symlink()
+            assert (out / "SSUD.WTH").read_text() == "forecast"
+
+
+def test_worker_soil_cache_counters_start_at_init(monkeypatch):
+    import collections
+
+    Info = collections.namedtuple("Info", ["hits", "misses"])
+    counts = {"profiles": Info(9, 1)}
+    monkeypatch.setattr(pythia.soil_handler, "soilCacheInfo", lambda: dict(counts))
+    monkeypatch.setattr(pythia.peerless, "_worker", {})
+    # The counters inherited from the parent are not counted again
+    pythia.peerless._init_worker({}, {}, [], [], [], None)
+    assert pythia.peerless._soil_cache_delta() == {"profiles": (0, 0)}
+    counts["profiles"] = Info(12, 3)
+    assert pythia.peerless._soil_cache_delta() == {"profiles": (3, 2)}
+
+
+def test_collect_chunk_adds_soil_cache_counters(tmp_path):
+    import pythia.manifest
+
+    manifest = pythia.manifest.Manifest(str(tmp_path / "manifest.db"))
+    manifest.begin()
+    cache_stats = {}
+    for chunk_stats in [
+        {"profiles": (1, 2)},
+        {"profiles": (3, 0), "ic_layers": (5, 1)},
+    ]:
+        result = ([None], chunk_stats)
+        assert (
+            pythia.peerless.collect_chunk(
+                result, {"silence": True}, {}, None, manifest, cache_stats
+            )
+            == []
+        )
+    assert cache_stats == {"profiles": [4, 2], "ic_layers": [5, 1]}
@@ -0,0 +1,193 @@
+import os
+
+import pythia.soil_handler
+
+
+SOIL_FILE = """*SOILS: Test soils
+
+*IB00000001  WISE        SCL     140 Test profile one
+@SITE        COUNTRY          LAT     LONG SCS FAMILY
+ -99         Nowhere        0.000    0.000 Test
+@ SCOM  SALB  SLU1  SLDR  SLRO  SLNF  SLPF  SMHB  SMPX  SMKE
+    BN  0.13   6.0  0.60  73.0  1.00  1.00 IB001 IB001 IB001
+@  SLB  SLMH  SLLL  SDUL  SSAT  SRGF  SSKS  SBDM  SLOC  SLCL
+     5   -99 0.124 0.242 0.421 1.000  1.21  1.50  1.02 21.00
+    15   -99 0.124 0.242 0.421 1.000  1.21  1.50  1.02 21.00
+    30   -99 0.139 0.259 0.420 0.638  0.74  1.52  0.73 26.00
+    60   -99 0.160 0.282 0.414 0.472  0.21  1.54  0.45 31.00
+   100   -99 0.171 0.292 0.411 0.301  0.14  1.55  0.30 33.00
+   150   -99 0.171 0.292 0.411 0.153  0.14  1.55  0.20 33.00
+
+*IB00000002  WISE        SIC     60  Test profile two
+@SITE        COUNTRY          LAT     LONG SCS FAMILY
+ -99         Nowhere        0.000    0.000 Test
+@  SLB  SLMH  SLLL  SDUL  SSAT  SRGF  SSKS  SBDM  SLOC  SLCL
+    20   -99 0.200 0.350 0.450 1.000  0.50  1.30  1.50 40.00
+    60   -99 0.210 0.360 0.440 0.500  0.30  1.35  0.80 42.00
+"""
+
+
+def _write_soil(tmp_path):
+    soil = tmp_path / "IB.SOL"
+    soil.write_text(SOIL_FILE)
+    return str(soil)
+
+
+def _scan(profile, soil_file):
+    """The profile lines as found by a line by line scan of the whole file."""
+    lines = []
+    found = False
+    with open(soil_file) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("*{}".format(profile)):
+                found = True
+            if found and line == "":
+                found = False
+            if found:
+                lines.append(line)
+    return lines
+
+
+def test_soil_index_matches_scan(tmp_path):
+    soil = _write_soil(tmp_path)
+    for profile in ["IB00000001", "IB00000002"]:
+        assert pythia.soil_handler.findSoilProfile(profile, [soil]) == soil
+        lines = pythia.soil_handler.readSoilProfileLines(profile, soil)
+        assert lines == _scan(profile, soil)
+    assert pythia.soil_handler.findSoilProfile("IB00000003", [soil]) is None
+    layers = pythia.soil_handler.readSoilLayers("IB00000002", soil)
+    assert layers["SLB"] == ["20", "60"]
+    assert layers["SBDM"] == ["1.30", "1.35"]
+
+
+def test_soil_index_sidecar(tmp_path):
+    soil = _write_soil(tmp_path)
+    index = pythia.soil_handler.getSoilIndex(soil, persist=True)
+    assert (tmp_path / "IB.SOL.idx").exists()
+    pythia.soil_handler._soil_indexes.clear()
+    assert pythia.soil_handler.getSoilIndex(soil) == index
+
+
+def test_extract_soil_profile(tmp_path):
+    soil = _write_soil(tmp_path)
+    extract_dir = str(tmp_path / "soils")
+    first = pythia.soil_handler.extractSoilProfile("IB00000001", soil, extract_dir)
+    second = pythia.soil_handler.extractSoilProfile("IB00000002", soil, extract_dir)
+    assert first != second
+    assert os.path.basename(first) == "IB.SOL"
+    assert pythia.soil_handler.readSoilLayers(
+        "IB00000002", second
+    ) == pythia.soil_handler.readSoilLayers("IB00000002", soil)
+    assert pythia.soil_handler.findSoilProfile("IB00000001", [second]) is None
+    pythia.soil_handler._extracted_profiles.clear()
+    assert (
+        pythia.soil_handler.extractSoilProfile("IB00000001", soil, extract_dir) == first
+    )
+    assert (
+        pythia.soil_handler.extractSoilProfile("IB00000003", soil, extract_dir) is None
+    )
+
+
+def test_cached_ic_layers(tmp_path):
+    soil = _write_soil(tmp_path)
+    pythia.soil_handler.setSoilCacheSize(16)
+    run = {"icin": 5, "icsw%": 25}
+    expected = pythia.soil_handler.calculateICLayerData(
+        pythia.soil_handler.readSoilLayers("IB00000001", soil), run
+    )
+    first = pythia.soil_handler.cachedICLayerData("IB00000001", soil, 5, 25)
+    second = pythia.soil_handler.cachedICLayerData("IB00000001", soil, 5, 25)
+    assert first == expected
+    assert second is first
+    pythia.soil_handler.cachedICLayerData("IB00000001", soil, 5, 50)
+    info = pythia.soil_handler.soilCacheInfo()
+    assert (info["ic_layers"].hits, info["ic_layers"].misses) == (1, 2)
+    assert (info["profiles"].hits, info["profiles"].misses) == (1, 1)
+
+
+def _random_profiles(count, seed=1):
+    import random
+
+    rng = random.Random(seed)
+    profiles = []
+    for _ in range(count):
+        depth = 0
+        slb = []
+        for _ in range(rng.randint(1, 9)):
+            depth += rng.choice([5, 10, 15, 20, 30, 45])
+            slb.append(depth)
+        profiles.append(
+            {
+                "SLB": [str(v) for v in slb],
+                "SBDM": ["{:.2f}".format(rng.uniform(0.9, 1.8)) for _ in slb],
+                "SLLL": ["{:.3f}".format(rng.uniform(0.05, 0.25)) for _ in slb],
+                "SDUL": ["{:.3f}".format(rng.uniform(0.25, 0.45)) for _ in slb],
+            }
+        )
+    return profiles
+
+
+def _rows(matrix, profiles):
+    return [matrix[row][: len(p["SLB"])] for row, p in enumerate(profiles)]
+
+
+def test_layer_math_matrix_parity():
+    sh = pythia.soil_handler
+    profiles = _random_profiles(200)
+    stacked = sh.stackSoilLayers(profiles)
+    slbs = [[int(v) for v in p["SLB"]] for p in profiles]
+    sbdms = [[float(v) for v in p["SBDM"]] for p in profiles]
+    lllss = [[float(v) for v in p["SLLL"]] for p in profiles]
+    duls = [[float(v) for v in p["SDUL"]] for p in profiles]
+
+    thickness = sh.calculateSoilThicknessMatrix(stacked["SLB"])
+    mp = sh.calculateSoilMidpointMatrix(stacked["SLB"])
+    tf = sh.calculateTopFracMatrix(stacked["SLB"], thickness)
+    bf = sh.calculateBotFracMatrix(stacked["SLB"], thickness)
+    mf = sh.calculateMidFracMatrix(tf, bf)
+    df = sh.calculateDepthFactorMatrix(mp, tf, mf)
+    wf = sh.calculateWeightingFactorMatrix(stacked["SBDM"], thickness, df)
+    mass = sh.calculateSoilLayerMassMatrix(stacked["SBDM"], thickness, stacked["mask"])
+    nconc = sh.calculateNConcentrationMatrix(5, mass)
+    twf = [sum(row) for row in _rows(wf.tolist(), profiles)]
+    icntot = sh.calculateICNTOTMatrix(wf, [5] * len(profiles), twf)
+    h2o = sh.calculateH2OMatrix(25, stacked["SLLL"], stacked["SDUL"])
+
+    for row, slb in enumerate(slbs):
+        n = len(slb)
+        s_thickness = sh.calculateSoilThickness(slb)
+        s_mp = sh.calculateSoilMidpoint(slb)
+        s_tf = sh.calculateTopFrac(slb, s_thickness)
+        s_bf = sh.calculateBotFrac(slb, s_thickness)
+        s_mf = sh.calculateMidFrac(s_tf, s_bf)
+        s_df = sh.calculateDepthFactor(s_mp, s_tf, s_mf)
+        s_wf = sh.calculateWeightingFactor(sbdms[row], s_thickness, s_df)
+        s_mass = sh.calculateSoilLayerMass(sbdms[row], s_thickness)
+        assert thickness[row, :n].tolist() == s_thickness
+        assert mp[row, :n].tolist() == s_mp
+        assert tf[row, :n].tolist() == s_tf
+        assert bf[row, :n].tolist() == s_bf
+        assert mf[row, :n].tolist() == s_mf
+        assert df[row, :n].tolist() == s_df
+        assert wf[row, :n].tolist() == s_wf
+        assert mass[row] == s_mass
+        assert nconc[row] == sh.calculateNConcentration(5, s_mass)
+        assert icntot[row, :n].tolist() == sh.calculateICNTOT(s_wf, 5, sum(s_wf))
+        assert h2o[row, :n].tolist() == sh.calculateH2O(25, lllss[row], duls[row])
+
+
+def test_ic_layer_data_matrix_parity():
+    profiles = _random_profiles(200, seed=2)
+    icin = [5 + (i % 3) for i in range(len(profiles))]
+    icsw = [25 + 10 * (i % 4) for i in range(len(profiles))]
+    matrix = pythia.soil_handler.calculateICLayerDataMatrix(profiles, icin, icsw)
+    scalar = [
+        pythia.soil_handler.calculateICLayerData(p, {"icin": n, "icsw%": sw})
+        for p, n, sw in zip(profiles, icin, icsw)
+    ]
+    assert matrix == scalar
+    assert pythia.soil_handler.calculateICLayerDataMatrix(profiles, 5, 25) == [
+        pythia.soil_handler.calculateICLayerData(p, {"icin": 5, "icsw%": 25})
+        for p in profiles
+    ]
@@ -0,0 +1,90 @@
+import pythia.template
+
+CONTEXT = {
+    "ingeno": "IB0001",
+    "cname": "maize",
+    "wsta": "SSUD",
+    "xcrd": 1.25,
+    "pdate": "1984-03-02",
+    "erain": "M1.2",
+    "fen_tot": 100.0,
+    "ic_layers": [{"icbl": 20, "sh2o": 0.2, "snh4": 0.1, "sno3": 0.5}],
+}
+
+
+def _env(tmp_path, templates):
+    for name, source in templates.items():
+        (tmp_path / name).write_text(source)
+    return pythia.template.init_engine(str(tmp_path))
+
+
+def test_template_variables_follow_includes(tmp_path):
+    env = _env(
+        tmp_path,
+        {
+            "MAIN.SNX": "{{ingeno}} {{pdate}}\n{% include 'IC.SNX' %}",
+            "IC.SNX": "{% for l in ic_layers %}{{l.icbl}}{% endfor %}{{hdate}}",
+        },
+    )
+    assert pythia.template.template_variables(env, "MAIN.SNX") == {
+        "ingeno",
+        "pdate",
+        "ic_layers",
+        "hdate",
+    }
+
+
+def test_template_variables_dynamic_include(tmp_path):
+    env = _env(tmp_path, {"MAIN.SNX": "{% include name %}"})
+    assert pythia.template.template_variables(env, "MAIN.SNX") is None
+
+
+def test_render_formats_only_referenced_variables(tmp_path):
+    source = (
+        "{{ingeno}}|{{wsta}}|{{xcrd}}|{{pdate}}|{{hdate}}|{{erain}}|{{edew}}\n"
+        "{% for l in ic_layers %}{{l.icbl}}|{{l.sh2o}}|{{l.icres}}{% endfor %}"
+    )
+    env = _env(tmp_path, {"MAIN.SNX": source})
+    expected = env.from_string(source).render(pythia.template.auto_format_dict(CONTEXT))
+    assert pythia.template.render_template(env, "MAIN.SNX", CONTEXT) == expected
+    keys, defaults = env.pythia_templates["MAIN.SNX"]
+    assert "fen_tot" not in keys
+    assert set(defaults) == {
+        "ingeno",
+        "wsta",
+        "xcrd",
+        "pdate",
+        "hdate",
+        "erain",
+        "edew",
+    }
+
+
+def test_wrap_format():
+    assert pythia.template.wrap_format("ingeno", "IB0001") == "IB0001"
+    assert pythia.template.wrap_format("wsta", "SSUD") == "SSUD    "
+    assert pythia.template.wrap_format("xcrd", 1.25) == "          1.250"
+    assert pythia.template.wrap_format("fdap", 5) == "    5"
+    assert pythia.template.wrap_format("famn", 5.0) == "  5.0"
+    assert pythia.template.wrap_format("icbl", -99) == "   -99"
+    assert pythia.template.wrap_format("cname", "maize") == "maize"
+    assert pythia.template.wrap_format("fen_tot", 100.0) == "100.0"
+
+
+def test_nested_dicts_get_every_default():
+    (layer,) = pythia.template.auto_format_dict(CONTEXT)["ic_layers"]
+    assert layer["icbl"] == "    20" and layer["icres"] == "   -99"
+    assert layer["edew"] == "A   0"
+    # Every nested dictionary gets its own copy of the defaults
+    layer["icres"] = "changed"
+    assert pythia.template.auto_format_dict({})["icres"] == "   -99"
+
+
+def test_bytecode_cache(tmp_path):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "MAIN.SNX").write_text("{{ingeno}}")
+    config = {"workDir": str(tmp_path / "work")}
+    cache_dir = pythia.template.bytecode_cache_dir(config)
+    env = pythia.template.init_engine(str(tmp_path / "templates"), cache_dir)
+    assert pythia.template.render_template(env, "MAIN.SNX", CONTEXT) == "IB0001"
+    assert len(list((tmp_path / "work" / ".jinja_cache").iterdir())) == 1